@@ -0,0 +1,284 @@
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from token_cache import scanTokens
+
+# each stage is run as its own command line in a scratch directory, the way
+# it is used, so peak RSS can be measured per stage
+HERE = Path(__file__).resolve().parent
+STAGES = {
+    'syntax_anl': ('syntax_anl.py', 'jack'),
+    'compiler':   ('compiler.py', 'jack'),
+    'vm_trans':   ('vm_trans.py', 'vm'),
+    'hack_asm':   ('hack_asm.py', 'asm')
+}
+JACK_OPS = ['+', '-', '&', '|', '<', '>', '=']
+VM_OPS = ['add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not']
+VM_SEGMENTS = ['local', 'argument', 'this', 'that', 'temp', 'pointer', 'static']
+ASM_COMPS = ['0', '1', '-1', 'D', 'A', 'M', '!D', '-M', 'D+1', 'M-1', 'D+A', 'D-M', 'M-D', 'D&A', 'D|M']
+ASM_JUMPS = ['JGT', 'JEQ', 'JGE', 'JLT', 'JNE', 'JLE', 'JMP']
+# runs a script as __main__ and reports its peak RSS on stderr, from
+# /proc where available
+STAGE_RUNNER = '''
+import os, runpy, sys
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
+if sys.argv[0] == '-c':
+    exec(sys.argv[1])
+else:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+rss = ''
+if os.path.exists('/proc/self/status'):
+    rss = [line.split()[1] for line in open('/proc/self/status') if line.startswith('VmHWM')][0]
+elif sys.platform != 'win32':
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+sys.stderr.write('peak_rss_kib {}\\n'.format(rss))
+'''
+
+def commentBlock(rnd, lines):
+    words = ['the', 'stack', 'frame', 'of', 'each', 'call', 'is', 'kept', 'in', 'RAM', 'until', 'return']
+    body = ['     * ' + ' '.join(rnd.choice(words) for _ in range(10)) for _ in range(lines)]
+    return ['    /**'] + body + ['     */']
+
+def jackExpression(rnd, depth, names, calls):
+    # nesting depth grows, size only linearly: one operand of each level is
+    # a plain term
+    if depth <= 0:
+        return rnd.choice([str(rnd.randint(0, 32767)), rnd.choice(names), rnd.choice(names), 'true', 'null'])
+    inner = jackExpression(rnd, depth - 1, names, calls)
+    kind = rnd.randint(0, 5)
+    if kind == 0:
+        return rnd.choice('-~') + '(' + inner + ')'
+    if kind == 1 and calls:
+        return '{}({}, {})'.format(rnd.choice(calls), inner, jackExpression(rnd, 0, names, calls))
+    if kind == 2:
+        return 'arr[{}]'.format(inner)
+    return '({} {} {})'.format(jackExpression(rnd, 0, names, calls), rnd.choice(JACK_OPS), inner)
+
+def jackClass(rnd, index, classes, functions, depth, comments):
+    name = 'Class{}'.format(index)
+    calls = ['Class{}.f{}'.format(rnd.randrange(classes), rnd.randrange(functions)) for _ in range(4)]
+    names = ['a', 'b', 'x', 'y', 'count']
+    lines = ['// synthetic benchmark class {}'.format(index), 'class {} {{'.format(name),
+             '    static int count;', '    static Array arr;', '']
+    for f in range(functions):
+        lines += commentBlock(rnd, comments)
+        lines += ['    function int f{}(int a, int b) {{'.format(f), '        var int x, y;',
+                  '        let x = {};'.format(jackExpression(rnd, depth, names, calls)),
+                  '        let arr[x] = {};'.format(jackExpression(rnd, depth, names, calls)),
+                  '        // loop until the counters meet',
+                  '        while ({}) {{'.format(jackExpression(rnd, depth // 2, names, calls)),
+                  '            let y = {};'.format(jackExpression(rnd, depth, names, calls)),
+                  '            if ({}) {{'.format(jackExpression(rnd, depth // 2, names, calls)),
+                  '                let count = count + 1;',
+                  '            } else {',
+                  '                do {}(x, y);'.format(rnd.choice(calls)),
+                  '            }',
+                  '        }',
+                  '        return {};'.format(jackExpression(rnd, depth, names, calls)),
+                  '    }', '']
+    lines.append('}')
+    return name, '\n'.join(lines) + '\n'
+
+def generateJack(rnd, classes, functions, depth, comments):
+    return dict(jackClass(rnd, i, classes, functions, depth, comments) for i in range(classes))
+
+def vmFunction(rnd, name, commands, labels):
+    lines = ['// {}'.format(name), 'function {} {}'.format(name, rnd.randint(0, 4))]
+    targets = ['L{}'.format(i) for i in range(labels)]
+    for i in range(commands):
+        kind = rnd.randint(0, 9)
+        if i % max(1, commands // labels) == 0 and targets:
+            lines.append('label ' + targets[(i // max(1, commands // labels)) % labels])
+        if kind < 4:
+            segment = rnd.choice(VM_SEGMENTS + ['constant'] * 3)
+            limit = {'temp': 7, 'pointer': 1}.get(segment, 20)
+            lines.append('push {} {}'.format(segment, rnd.randint(0, limit)))
+        elif kind < 6:
+            segment = rnd.choice(VM_SEGMENTS)
+            limit = {'temp': 7, 'pointer': 1}.get(segment, 20)
+            lines.append('pop {} {}'.format(segment, rnd.randint(0, limit)))
+        elif kind < 8:
+            lines.append(rnd.choice(VM_OPS))
+        elif kind == 8 and targets:
+            lines.append('{} {}'.format(rnd.choice(['goto', 'if-goto']), rnd.choice(targets)))
+        else:
+            lines.append('call Bench{}.f{} {}'.format(rnd.randrange(4), rnd.randrange(4), rnd.randint(0, 3)))
+    lines.append('return')
+    return lines
+
+def generateVm(rnd, classes, functions, commands, labels):
+    files = {}
+    for c in range(classes):
+        lines = []
+        for f in range(functions):
+            lines += vmFunction(rnd, 'Bench{}.f{}'.format(c, f), commands, labels)
+        files['Bench{}'.format(c)] = '\n'.join(lines) + '\n'
+    files['Sys'] = 'function Sys.init 0\ncall Bench0.f0 0\nlabel END\ngoto END\n'
+    return files
+
+def generateAsm(rnd, labels, instructions, comments):
+    lines = ['// synthetic benchmark program']
+    for label in range(labels):
+        lines += ['// ' + 'block {} '.format(label) * 4 for _ in range(comments)]
+        lines.append('(LOOP.{})'.format(label))
+        for _ in range(instructions):
+            kind = rnd.randint(0, 5)
+            if kind == 0:
+                lines.append('@{}'.format(rnd.randint(0, 32767)))
+            elif kind == 1:
+                lines.append('@var{}'.format(rnd.randrange(200)))
+            elif kind == 2:
+                lines.append('@LOOP.{}'.format(rnd.randrange(labels)))
+                lines.append('D;{}'.format(rnd.choice(ASM_JUMPS)))
+            else:
+                lines.append('{}={}'.format(rnd.choice(['D', 'M', 'A', 'MD', 'AM', 'AD', 'AMD']), rnd.choice(ASM_COMPS)))
+    lines += ['(END)', '@END', '0;JMP']
+    return '\n'.join(lines) + '\n'
+
+def writeSources(directory, sources, extension):
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, text in sources.items():
+        (directory / '{}.{}'.format(name, extension)).write_text(text)
+
+def countWorkload(texts, kind):
+    # lines are all source lines; tokens are Jack tokens, or the words of the
+    # VM commands and assembly instructions with comments stripped
+    lines = tokens = 0
+    for text in texts:
+        lines += text.count('\n')
+        if kind == 'jack':
+            tokens += sum(1 for _ in scanTokens(text))
+        else:
+            tokens += sum(len(line.split('//')[0].split()) for line in text.splitlines())
+    return lines, tokens
+
+def runCommand(args, cwd):
+    # wall time and peak RSS in KiB of one child process; the child reports
+    # its own peak, since a forked child inherits the RSS high-water mark of
+    # this process
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', STAGE_RUNNER] + args, cwd=cwd,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode:
+        raise RuntimeError('{} failed:\n{}'.format(' '.join(args), proc.stderr))
+    rss = proc.stderr.rsplit('peak_rss_kib ', 1)[-1].strip()
+    return elapsed, int(rss) if rss.isdigit() else None
+
+def runStage(stage, source, workdir, flags):
+    script = STAGES[stage][0]
+    args = [str(HERE / script), str(source)]
+    if stage in ('compiler', 'vm_trans'):
+        args += flags
+    return runCommand(args, workdir)
+
+def runPipeline(jack_dir, workdir, flags):
+    # compiler -> vm_trans -> hack_asm on the pipeline classes
+    vm_dir = workdir / 'Pipeline'
+    vm_dir.mkdir(exist_ok=True)
+    steps = [runStage('compiler', jack_dir, vm_dir, flags),
+             runStage('vm_trans', vm_dir, workdir, flags),
+             runStage('hack_asm', workdir / 'Pipeline.asm', workdir, flags)]
+    rss = [r for _, r in steps]
+    return sum(t for t, _ in steps), None if None in rss else max(rss)
+
+def measure(run, repeat):
+    # best time of the repeats, peak RSS over all of them
+    times, peaks = [], []
+    for _ in range(repeat):
+        elapsed, rss = run()
+        times.append(elapsed)
+        peaks.append(rss)
+    return min(times), None if None in peaks else max(peaks)
+
+def benchmark(args, root):
+    rnd = random.Random(args.seed)
+    jack = generateJack(rnd, args.classes, args.functions, args.depth, args.comments)
+    vm = generateVm(rnd, args.classes, args.functions, args.commands, args.labels)
+    # the assembly workload and the pipeline output have to fit the 32K ROM,
+    # so the pipeline only builds the first classes of the Jack workload
+    asm = generateAsm(rnd, args.classes * args.labels, max(1, args.commands // 4), args.comments)
+    pipeline = {name: jack[name] for name in list(jack)[:args.pipeline_classes]}
+    writeSources(root / 'Jack', jack, 'jack')
+    writeSources(root / 'Vm', vm, 'vm')
+    writeSources(root / 'Pipeline', pipeline, 'jack')
+    (root / 'Bench.asm').write_text(asm)
+    sources = {'jack': (root / 'Jack', jack.values()), 'vm': (root / 'Vm', vm.values()),
+               'asm': (root / 'Bench.asm', [asm]), 'pipeline': (root / 'Pipeline', pipeline.values())}
+    flags = ['-O'] if args.optimize else []
+    print('Running startup')
+    startup = measure(lambda: runCommand(['-c', 'import syntax_anl, compiler, vm_trans, hack_asm'], HERE), args.repeat)
+    results = {}
+    for stage, (_, kind) in STAGES.items():
+        if args.stage and stage not in args.stage:
+            continue
+        source, texts = sources[kind]
+        out = root / 'out' / stage
+        out.mkdir(parents=True, exist_ok=True)
+        print('Running {}'.format(stage))
+        results[stage] = (kind,) + measure(lambda: runStage(stage, source, out, flags), args.repeat)
+    if not args.stage or 'pipeline' in args.stage:
+        out = root / 'out' / 'pipeline'
+        out.mkdir(parents=True, exist_ok=True)
+        print('Running pipeline')
+        results['pipeline'] = ('pipeline',) + measure(lambda: runPipeline(root / 'Pipeline', out, flags), args.repeat)
+    report = {'startup': {'seconds': round(startup[0], 4), 'peak_rss_kib': startup[1]}}
+    for stage, (kind, elapsed, rss) in results.items():
+        lines, tokens = countWorkload(sources[kind][1], 'jack' if kind == 'pipeline' else kind)
+        report[stage] = {'input': kind, 'lines': lines, 'tokens': tokens, 'seconds': round(elapsed, 4),
+                         'lines_per_sec': round(lines / elapsed), 'tokens_per_sec': round(tokens / elapsed),
+                         'peak_rss_kib': rss}
+    return report
+
+def formatReport(report):
+    rows = ['{:<12}{:>10}{:>10}{:>10}{:>14}{:>14}{:>12}'.format(
+        'stage', 'lines', 'tokens', 'seconds', 'lines/s', 'tokens/s', 'RSS KiB')]
+    for stage, r in report.items():
+        rss = '-' if r['peak_rss_kib'] is None else r['peak_rss_kib']
+        if stage == 'startup':
+            rows.append('{:<12}{:>10}{:>10}{:>10.3f}{:>14}{:>14}{:>12}'.format(stage, '', '', r['seconds'], '', '', rss))
+            continue
+        rows.append('{:<12}{:>10}{:>10}{:>10.3f}{:>14}{:>14}{:>12}'.format(
+            stage, r['lines'], r['tokens'], r['seconds'], r['lines_per_sec'], r['tokens_per_sec'], rss))
+    return '\n'.join(rows)
+
+def main ():
+    argparser = argparse.ArgumentParser(description='Benchmark the JACK toolchain on synthetic workloads')
+    argparser.add_argument('--classes', type=int, default=20, help='number of Jack classes and VM files')
+    argparser.add_argument('--functions', type=int, default=10, help='functions per class')
+    argparser.add_argument('--depth', type=int, default=12, help='nesting depth of the generated Jack expressions')
+    argparser.add_argument('--comments', type=int, default=20, help='lines per comment block')
+    argparser.add_argument('--commands', type=int, default=200, help='commands per VM function, a quarter of that per assembly block')
+    argparser.add_argument('--labels', type=int, default=20, help='labels per VM function, assembly blocks per class')
+    argparser.add_argument('--pipeline-classes', type=int, default=1,
+                           help='Jack classes built by the pipeline, the program has to fit the 32K ROM')
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best time is reported')
+    argparser.add_argument('--stage', action='append', choices=list(STAGES) + ['pipeline'],
+                           help='only run this stage, may be repeated')
+    argparser.add_argument('-O', dest='optimize', action='store_true', help='pass -O to compiler.py and vm_trans.py')
+    argparser.add_argument('--workdir', help='keep the workloads and outputs in this directory')
+    argparser.add_argument('--output', default='benchmark.json', help='JSON file the results are written to')
+    args = argparser.parse_args()
+    if args.workdir:
+        report = benchmark(args, Path(args.workdir).resolve())
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            report = benchmark(args, Path(workdir))
+    print(formatReport(report))
+    result = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'options': vars(args), 'stages': report}
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('Results written to %s' % args.output)
+
+if __name__ == "__main__":
+    main()
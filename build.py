@@ -0,0 +1,65 @@
+import argparse
+import itertools
+import os
+from pathlib import Path
+import compiler
+import vm_ir
+import vm_trans
+import hack_asm
+
+def compileClasses(files, token_cache=False, optimize=False, intermediate=False):
+    # (class name, VmCommand records) for each Jack file, as the compiler
+    # generates them; a class is only compiled when the translator asks for it
+    for fl in files:
+        print('Compiling %s' % fl.stem)
+        commands, signature, depends, xml_data = compiler.compileCommands(fl, token_cache=token_cache, optimize=optimize)
+        if intermediate:
+            compiler.writeFile(vm_ir.formatVm(commands), fl.stem)
+        yield fl.stem, commands
+
+def teeRecords(records, filename):
+    # passes the instruction records on while writing them to filename as
+    # assembly, one instruction or label per line
+    with open(filename, 'w', buffering=vm_trans.OUTPUT_BUFFER) as f:
+        for record in records:
+            f.write(hack_asm.formatRecord(record) + '\n')
+            yield record
+
+def programName(path):
+    # file stem for a .jack file, directory name for a project, also for '.'
+    p = Path(path)
+    return p.stem if p.is_file() else p.resolve().name
+
+def build(path, optimize=False, size=False, token_cache=False, intermediate=False):
+    # Jack -> VM -> assembly -> Hack in one process, returns the program
+    # words. The stages are chained generators and nothing is parsed twice:
+    # the compiler hands on VmCommand records and the translator hack_asm
+    # instruction records. Nothing is written unless intermediate is set,
+    # which keeps a .vm file per class and the .asm file, without comments.
+    p = Path(path)
+    files = [p] if p.is_file() else list(p.glob('*.jack'))
+    modules = compileClasses(files, token_cache, optimize, intermediate)
+    records = itertools.chain.from_iterable(vm_trans.translateModules(modules, optimize or size, size, records=True))
+    if intermediate:
+        records = teeRecords(records, '{}.asm'.format(programName(p)))
+    return hack_asm.assembleRecords(records)
+
+def main ():
+    argparser = argparse.ArgumentParser(description='Build a HACK binary program from JACK code in one process')
+    argparser.add_argument('input')
+    argparser.add_argument('-O', dest='optimize', action='store_true', help='optimize in the compiler and the VM translator')
+    argparser.add_argument('--size', action='store_true', help='translate with shared call, return and compare routines')
+    argparser.add_argument('--token-cache', action='store_true',
+                           help='read tokens from the .tokens cache next to each source file')
+    argparser.add_argument('--intermediate', action='store_true', help='also write the .vm files and the .asm file, without comments')
+    argparser.add_argument('--format', choices=hack_asm.FORMATS, default='hack', help='output format, as for hack_asm.py')
+    args = argparser.parse_args()
+    if not os.path.exists(args.input):
+        print('Path error')
+        return None
+    words = build(args.input, args.optimize, args.size, args.token_cache, args.intermediate)
+    hack_asm.writeFile([words], programName(args.input), args.format)
+    print('Built {} words'.format(len(words)))
+
+if __name__ == "__main__":
+    main()
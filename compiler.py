@@ -1,7 +1,14 @@
 import argparse
-import re
 import os
+import json
+import hashlib
+import functools
+import time
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from token_cache import cachedTokens, tokenize, KEYWORD_SET
+from vm_ir import (VmCommand, parseCommand, formatVm, PUSH, POP, NEG, NOT, LABEL, GOTO, IF_GOTO,
+                   FUNCTION, CALL, RETURN, CONSTANT, ARGUMENT, TEMP, POINTER, THAT, SEGMENT_CODES)
 import xml.etree.ElementTree as ET
 
 FILE = {
@@ -9,62 +16,6 @@ FILE = {
     "name": ""
 }
 
-KEYWORDS = ['boolean',
-            'char',
-            'class',
-            'constructor',
-            'do',
-            'else',
-            'false',
-            'field',
-            'function',
-            'if',
-            'int',
-            'let',
-            'method',
-            'null',
-            'return',
-            'static',
-            'this',
-            'true',
-            'var',
-            'void',
-            'while']
-
-SYMBOLS = ['{',
-           '}',
-           '(',
-           ')',
-           '[',
-           ']',
-           '.',
-           ',',
-           ';',
-           '+',
-           '-',
-           '*',
-           '/',
-           '&',
-           '|',
-           '<',
-           '>',
-           '=',
-           '~']
-
-TOKEN_SEPARATOR = SYMBOLS + [' ', '\r']
-
-PATTERNS = (
-    ('|'.join(['^{}$'.format(x) for x in KEYWORDS]), 'keyword',0),
-    ('|^\\'.join(SYMBOLS), 'symbol',0),
-    ('^([0-9]*$)',  'integerConstant',1),
-    ('^\"(.*)\"', 'stringConstant',1),
-    ('^([a-zA-Z_][a-zA-Z_0-9]*$)', 'identifier',1)
-)
-CLASS_ST = []
-CLASS_ST_NEW = []
-SUB_ST = []
-CLASS_INDEX = {'field':  0,
-               'static': 0}
 SUB_INDEX = {'argument': 0,
              'local':    0,
              'name': '',
@@ -72,8 +23,13 @@ SUB_INDEX = {'argument': 0,
 
 CLASS_NAME =''
 
-OS_CLASSES = ['Math','Memory','Screen','Output','Keyboard','String','Array','Sys']
-COMP_CLASSES = []
+CACHE_FILE = '.jackcache'
+
+# phases of compileFile in the order they run, as reported by --profile
+PROFILE_PHASES = ['read', 'tokenize', 'parse', 'xml', 'fold', 'write', 'peephole', 'format', 'output']
+
+CLASS_SIGNATURE = []
+CLASS_DEPENDS = set()
 
 OPS = {'+':'add',
        '-':'sub',
@@ -87,1058 +43,1230 @@ OPS = {'+':'add',
 
 UNOPS = {'-':'neg', '~':'not'}
 
-CODE = ''
-
-def varDefined(var_name):
-    sub_vars = [x['name'] for x in SUB_ST]
-    class_vars = [x['name'] for x in CLASS_ST]
-    if var_name in sub_vars:
-        return SUB_ST[sub_vars.index(var_name)]
-    elif var_name in class_vars:
-        return CLASS_ST[class_vars.index(var_name)]
-    else:
-        return None
-
-def findVar(name, class_st, sub_st):
-    var_list = class_st.copy()
-    var_list.extend(sub_st)
-    for var in var_list:
-        if var['name'] == name:
-            return var
+# the VM code is generated as VmCommand records
+OP_COMMANDS = {op: parseCommand(command) for op, command in OPS.items()}
+UNOP_COMMANDS = {op: parseCommand(command) for op, command in UNOPS.items()}
+
+KEYWORD_CONSTANTS = frozenset(['true', 'false', 'null', 'this'])
+CLASS_VAR_KWDS = frozenset([('keyword', 'static'), ('keyword', 'field')])
+SUBROUTINE_KWDS = frozenset([('keyword', 'constructor'), ('keyword', 'function'), ('keyword', 'method')])
+TYPE_KWDS = frozenset([('keyword', 'int'), ('keyword', 'char'), ('keyword', 'boolean')])
+END_TOKEN = (None, None)
+
+# VM commands folded by the peephole pass when both operands are constants
+CONST_FOLDS = {parseCommand(command): fold for command, fold in [
+               ('add', lambda a, b: a + b),
+               ('sub', lambda a, b: a - b),
+               ('and', lambda a, b: a & b),
+               ('or', lambda a, b: a | b),
+               ('call Math.multiply 2', lambda a, b: a * b),
+               ('call Math.divide 2', lambda a, b: a // b if b else None),
+               ('eq', lambda a, b: -(a == b)),
+               ('lt', lambda a, b: -(a < b)),
+               ('gt', lambda a, b: -(a > b))]}
+# commands leaving 0 or -1 on the stack
+BOOLEAN_COMMANDS = frozenset(map(parseCommand, ['eq', 'lt', 'gt']))
+PUSH_CONSTANT = (PUSH, CONSTANT)
+PUSH_ZERO = VmCommand(PUSH, CONSTANT, 0)
+NOT_COMMAND = parseCommand('not')
+ADD_COMMAND = parseCommand('add')
+NO_COMMAND = VmCommand(None)
+
+VM_CODE = []
+
+# largest constant factor compiled to an add chain instead of Math.multiply
+MUL_CHAIN_MAX = 64
+
+class Symbol:
+    __slots__ = ('name', 'type', 'category', 'index', 'segment')
+
+    def __init__(self, name, type, category, index):
+        self.name = name
+        self.type = type
+        self.category = category
+        self.index = index
+        self.segment = SEGMENT_CODES['this' if category == 'field' else category]
+
+
+class SymbolTable:
+    # class and subroutine scopes indexed by name, with a running count per
+    # category that gives the index of the next variable
+    def __init__(self):
+        self.class_scope = {}
+        self.sub_scope = {}
+        self.counts = {'static': 0, 'field': 0, 'argument': 0, 'local': 0}
+
+    def startClass(self):
+        self.class_scope = {}
+        self.counts['static'] = 0
+        self.counts['field'] = 0
+        self.startSubroutine()
+
+    def startSubroutine(self):
+        self.sub_scope = {}
+        self.counts['argument'] = 0
+        self.counts['local'] = 0
+
+    def define(self, name, var_type, category):
+        scope = self.class_scope if category in ('static', 'field') else self.sub_scope
+        # a redeclared name keeps its first entry but still takes an index
+        scope.setdefault(name, Symbol(name, var_type, category, self.counts[category]))
+        self.counts[category] += 1
+
+    def varCount(self, category):
+        return self.counts[category]
+
+    def find(self, name):
+        # class scope is searched first, as code generation always did
+        var = self.class_scope.get(name)
+        if var is None:
+            var = self.sub_scope.get(name)
+        return var
+
+SYMBOL_TABLE = SymbolTable()
+
+def findVar(name):
+    return SYMBOL_TABLE.find(name)
 
 class tokenIterator:
-    def __init__(self, input_file):
-        self.input_file = input_file
-        self.processed = True
-        self.token = ''
+    # the parser reads the (type, text) records of a file through a cursor
+    # with peek(k)/advance() and can back up with mark()/reset(); the
+    # predictive parser itself never needs to
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
 
     def __iter__(self):
-        self.token = ''
         return self
 
-    def getStatus(self):
-        return self.processed
+    def __next__(self):
+        if self.pos >= len(self.tokens):
+            raise StopIteration
+        return self.advance()
 
-    def setProcessed(self):
-        self.processed = True
+    def peek(self, k=0):
+        # k-th token after the cursor, END_TOKEN past the end of the file
+        pos = self.pos + k
+        if pos < len(self.tokens):
+            return self.tokens[pos]
+        return END_TOKEN
 
-    def getCurrentToken(self):
-        return self.token
+    def advance(self):
+        token = self.peek()
+        self.pos += 1
+        return token
 
-    def __next__(self):
-        self.token=''
-        char = self.input_file.read(1).decode('utf-8')
-        if char in SYMBOLS:
-            if char == '/':
-                next_char = self.input_file.read(1).decode('utf-8')
-                if next_char == '/':
-                    self.input_file.readline()
-                    return next(self)
-                elif next_char == '*':
-                    blockcomment_end1 = self.input_file.read(1).decode('utf-8')
-                    blockcomment_end2 = self.input_file.read(1).decode('utf-8')
-                    while not(blockcomment_end1 == '*' and blockcomment_end2 == '/') and not(blockcomment_end1 == '' or blockcomment_end2 == ''):
-                        blockcomment_end1 = self.input_file.read(1).decode('utf-8')
-                        if blockcomment_end1 == '*':
-                            blockcomment_end2 = self.input_file.read(1).decode('utf-8')
-                    return next(self)
-                else:
-                    self.input_file.seek(self.input_file.tell() - 1, 0)   # move read cursor one char back
-                    self.token = parseToken(char)
-                    self.processed = False
-                    return self.token
-            else:
-                self.token = parseToken(char)
-                self.processed = False
-                return self.token
-        elif char == '"':
-            self.token = char
-            next_char = self.input_file.read(1).decode('utf-8')
-            while (next_char != '"'):
-                self.token += next_char
-                next_char = self.input_file.read(1).decode('utf-8')
-            else:
-                self.token += next_char
-            self.token = parseToken(self.token)
-            self.processed = False
-            return self.token
-        elif (char.isalnum() or char == '_'):
-            while ((char != '') and not(char in TOKEN_SEPARATOR)):
-                self.token += char
-                char = self.input_file.read(1).decode('utf-8')
-            self.input_file.seek(self.input_file.tell() - 1, 0)
-            self.token = parseToken(self.token)
-            self.processed = False
-            return self.token
-        elif char == '':
-            raise StopIteration
-        else:
-            return next(self)
+    def mark(self):
+        return self.pos
 
+    def reset(self, mark):
+        self.pos = mark
 
-def parseToken(word):
-    rules = [ matchApplyBuilder(pattern, token_type, match_group) for (pattern, token_type, match_group) in PATTERNS ]
-    token_matched = False
-    for matchRule, applyRule in rules:
-        if matchRule(word) and not(token_matched):
-            token_matched = True
-            return applyRule(word)
-    return None
 
-def matchApplyBuilder(pattern, token_type, match_group):
-    def matchRule(word):
-        return re.search(pattern, word)
-    def applyRule(word):
-        match = re.search(pattern, word)
-        if match:
-            return (token_type, match.group(match_group))
-    return (matchRule, applyRule)
-
-
-def compile(tokenizer):
-
-    def createXmlElement(token, attributes={}):
-        token_type, token_text = token
-        elem = ET.Element(token_type)
-        elem.text = '{}'.format(token_text)
-        elem.attrib = attributes
-        return elem
-        
-
-    def compileToken(expected_type, expected_text=None, allow_to_fail=False, tokenizer=tokenizer, attributes={}):
-        if tokenizer.getStatus():
-            token_type, token_text = next(tokenizer)
-            # print('Retrieved next token: ', token_type, token_text)
-        else:
-            token_type, token_text = tokenizer.getCurrentToken()
-            # print('Using existing token: ', token_type, token_text)
-        if (expected_text == None):
-            if (expected_type == token_type):
-                elem = createXmlElement((token_type, token_text), attributes)
-                tokenizer.setProcessed()
-                return elem
-            else:
-                if allow_to_fail:
-                    return None
-                else:
-                    raise ValueError('Expeting type "{}", got type "{}"'.format(expected_type, token_type))    
-        else:
-            if (expected_text == token_text) and (expected_type == token_type):
-                elem = createXmlElement((token_type, token_text),attributes)
-                tokenizer.setProcessed()
-                return elem
-            else:
-                if allow_to_fail:
-                    return None
-                else:
-                    raise ValueError('Expeting {}, got {}'.format(expected_text, token_text))
-    
-    def compileOrAlt(fns, store_in_st=''):
-        for fn, arg in fns:
-            elem = fn(*arg, allow_to_fail=True)
-            if elem != None:
-                if store_in_st == '':
-                    return elem
-                else:
-                    return elem
-        raise ValueError('Unexpected token')
-
-    def compileGroup(fns):
-        result = []
-        for fn, arg in fns:
-            elem = fn(*arg)
-            try:
-                elem.tag
-                result.append(elem)
-            except AttributeError:
-                result.extend(elem)
-        return result
-
-    def compileZeroOrOne(fn):
-        try:
-            elem = fn()
-            return elem
-        except ValueError:
-            return None
+class ClassNode:
+    __slots__ = ('name', 'var_decs', 'subroutines')
 
-    def compileZeroOrMore(fn):
-        result = []
-        while True:
-            try:
-                elem = fn()
-                try:
-                    elem.tag
-                    result.append(elem)
-                except AttributeError:
-                    result.extend(elem)
-            except ValueError:
-                break
-        return result
+    def __init__(self, name, var_decs, subroutines):
+        self.name = name
+        self.var_decs = var_decs
+        self.subroutines = subroutines
 
-    def compileClass():
-        root = ET.Element('class')
-        child_list = []
-        child_list.append(compileToken(expected_type='keyword', expected_text='class'))
-        child_list.append(compileClassName())
-        child_list.append(compileToken(expected_type='symbol', expected_text='{'))
-        elem = compileZeroOrMore(compileClassVarDec)
-        if elem != []:
-            child_list.extend(elem)
-        elem = compileZeroOrMore(compileSubroutineDec)
-        if elem != []:
-            child_list.extend(elem)
-        child_list.append(compileToken(expected_type='symbol', expected_text='}'))
-        for child in child_list:
-            if child != None:
-                root.append(child)
-        # return ET.tostring(root, encoding='unicode', method='xml')
-        return writeClass(root)
-
-    def compileClassName():
-        atr = {'category':'class', 'used':'False'}
-        elem = compileToken(expected_type='identifier', attributes=atr)
-        return elem
- 
+class ClassVarDec:
+    __slots__ = ('category', 'type', 'names')
 
-    def compileClassVarDec():
-        def compileClassVarField():
-            return compileToken('keyword','field')
-            
-        def compileClassVarStatic():
-            return compileToken('keyword','static')
-
-        def compileVarNameGr(atr):
-            def formGroup1():
-                return compileGroup([
-                    (compileToken, ['symbol', ',']),
-                    (compileVarName, [atr, False, True])
-                ])
-            return compileZeroOrMore(formGroup1)
-
-        def formClassVarField():
-            atr = {'category':'field', 'used':'False'}
-            return compileGroup([
-                (compileClassVarField, []),
-                (compileType, []),
-                (compileVarName, [atr, False, True]),
-                (compileVarNameGr, [atr]),
-                (compileToken, ['symbol', ';'])
-            ])
-        
-        def formClassVarStatic():
-            atr = {'category':'static', 'used':'False'}
-            return compileGroup([
-                (compileClassVarStatic, []),
-                (compileType, []),
-                (compileVarName, [atr, False, True]),
-                (compileVarNameGr, [atr]),
-                (compileToken, ['symbol', ';'])
-            ])
-
-        def formClassVarDec():
-            stmnts = [formClassVarField, formClassVarStatic]
-            for fn in stmnts:
-                try:
-                    elem = fn()
-                    if elem != None:
-                        return elem
-                except ValueError:
-                    continue
-            raise ValueError('Cannot parse')
-
-        child_list = formClassVarDec()
-        if child_list != []:
-            root = ET.Element('classVarDec')
-            for child in child_list:
-                root.append(child)
-            return root
-        else:
-            return []
+    def __init__(self, category, var_type, names):
+        self.category = category
+        self.type = var_type
+        self.names = names
 
-    def compileVarName(atr={}, allow_to_fail=False, store=False):
-        elem = compileToken('identifier', None, allow_to_fail=allow_to_fail)
-        return elem
+class Subroutine:
+    __slots__ = ('kind', 'return_type', 'name', 'params', 'var_decs', 'statements')
 
+    def __init__(self, kind, return_type, name, params, var_decs, statements):
+        self.kind = kind
+        self.return_type = return_type
+        self.name = name
+        self.params = params
+        self.var_decs = var_decs
+        self.statements = statements
 
-    def compileType():
-        return compileOrAlt([
-            (compileToken, ['keyword','int']),
-            (compileToken, ['keyword','char']),
-            (compileToken, ['keyword','boolean']),
-            (compileVarName, [])
-        ], 'type')
-
-    def writeClass(elem):
-        global CLASS_ST, CLASS_NAME, COMP_CLASSES
-        CLASS_ST = []
-        class_name = elem.find('identifier')
-        class_vars = elem.findall('classVarDec')
-        for var in class_vars:
-            category = var.find('keyword')
-            var_type = var[1]
-            index = len(list(filter(lambda x: x['category']==category.text, CLASS_ST)))
-            for ident in var[2:]:
-                if ident.tag == 'identifier':
-                    CLASS_ST.append({'category': category.text, 'name': ident.text, 'type': var_type.text, 'index': index})
-                    index += 1
-        CLASS_NAME = class_name.text
-        COMP_CLASSES.append(CLASS_NAME)
-        return writeFunctions(elem)
-
-    def writeFunctions(elem):
-        functions = elem.findall('subroutineDec')
-        if functions != None:
-            result = ''.join([writeFunction(x) for x in functions])
-        return result
-
-    def writeFunction(elem):
-        global CLASS_NAME, SUB_INDEX, SUB_ST
-        SUB_ST = []
-        SUB_INDEX = {'argument': 0,
-             'local':    0,
-             'name': '',
-             'label': 0}
-        fun_type = elem.find('keyword')
-        fun_ret_type = elem[1]
-        fun_name = elem[2]
-        if fun_type.text == 'method':
-            SUB_ST.append({'category': 'argument', 'type': CLASS_NAME, 'name': 'this', 'index': 0})
-        params = zip(elem.find('parameterList')[0::3], elem.find('parameterList')[1::3])
-        for param_type, param_name in params:
-            index = len(list(filter(lambda x: x['category']=='argument', SUB_ST)))
-            SUB_ST.append({'category': 'argument', 'type': param_type.text, 'name': param_name.text, 'index': index})
-        sub_vars = elem.findall('./subroutineBody/varDec')
-        for item in sub_vars:
-            var_type = item[1]
-            var_names = item[2::2]
-            for var_name in var_names:
-                index = len(list(filter(lambda x: x['category']=='local', SUB_ST)))
-                SUB_ST.append({'category': 'local', 'type': var_type.text, 'name': var_name.text, 'index': index})
-        locals_count = len(list(filter(lambda x: x['category']=='local', SUB_ST)))
-        result = 'function {}.{} {}\n'.format(CLASS_NAME, fun_name.text, locals_count)
-        if fun_type.text == 'constructor':
-            field_count = len(list(filter(lambda x: x['category']=='field', CLASS_ST)))
-            result += 'push constant {}\ncall Memory.alloc 1\npop pointer 0\n'.format(field_count)
-        if fun_type.text == 'method':
-            result += 'push argument 0\npop pointer 0\n'
-        statements = elem.find('subroutineBody').find('statements')
-        result += writeStatements(statements)
-        return result
-        
+class VarDec:
+    __slots__ = ('type', 'names')
 
+    def __init__(self, var_type, names):
+        self.type = var_type
+        self.names = names
 
-    def compileSubroutineDec():
-        def compileSubDecKwd():
-            return compileOrAlt([
-                (compileToken, ['keyword','constructor']),
-                (compileToken, ['keyword','function']),
-                (compileToken, ['keyword','method'])
-            ])
-
-        def compileTypeVoid():
-            return compileOrAlt([
-                (compileToken, ['keyword','int']),
-                (compileToken, ['keyword','char']),
-                (compileToken, ['keyword','boolean']),
-                (compileToken, ['identifier', None]),
-                (compileToken, ['keyword','void'])
-            ])
-
-        def compileParamName(atr={}, allow_to_fail=False, store=False):
-            elem = compileToken('identifier', None, allow_to_fail=allow_to_fail)
-            return elem
-
-        def compileParamList():
-            def formGroup1():
-                return compileGroup([
-                    (compileType, []),
-                    (compileParamName, [{}, False, True])
-                ])
-
-            def formGroup2():
-                return compileGroup([
-                    (compileToken, ['symbol', ',']),
-                    (compileType, []),
-                    (compileParamName, [{}, False, True])
-                ])
-            def formGroup3():
-                return compileGroup([
-                    (formGroup1, []),
-                    (compileZeroOrMore, [formGroup2])
-                ])
-            def formGroup4():
-               return compileZeroOrOne(formGroup3)
-
-            child_list = formGroup4()
-            root = ET.Element('parameterList')
-            if child_list != None:
-                for child in child_list:
-                    root.append(child)
-                return root
-            else:
-                root.text = '\r\n'
-                return root
-        
-        def compileSubName():
-            elem = compileToken('identifier', None)
-            return elem
-
-        def formSubGr():
-            return compileGroup([
-                (compileSubDecKwd, []),
-                (compileTypeVoid, []),
-                (compileSubName, []),
-                (compileToken, ['symbol', '(']),
-                (compileParamList, []),
-                (compileToken, ['symbol', ')']),
-                (compileSubBody, [])
-            ])
-            
-        child_list = formSubGr()
-        if child_list != []:
-            root = ET.Element('subroutineDec')
-            for child in child_list:
-                root.append(child)
-            return root
-        else:
-            return []
-
-    def compileSubBody():
-        def compileVarDec():
-            def compileVarNameGr():
-                def formGroup1():
-                    return compileGroup([
-                        (compileToken, ['symbol', ',']),
-                        (compileLocalVarName, [{}, False, True])
-                    ])
-                return compileZeroOrMore(formGroup1)
-
-
-            def formGroup():
-                return compileGroup([
-                    (compileToken, ['keyword', 'var']),
-                    (compileType, []),
-                    (compileLocalVarName, [{}, False, True]),
-                    (compileVarNameGr, []),
-                    (compileToken, ['symbol',';'])
-                ])
-
-            def compileLocalVarName(atr={}, allow_to_fail=False, store=False):
-                elem = compileToken('identifier', None, allow_to_fail=allow_to_fail)
-                return elem
-
-            def compileVarDecLine():
-                child_list = formGroup()
-                root = ET.Element('varDec')
-                if child_list != []:
-                    for child in child_list:
-                        root.append(child)
-                    return root
-                else:
-                    root.text = '\r\n'
-                    return root    
-
-            return compileZeroOrMore(compileVarDecLine)
-            
-
-        def formBodyGr():
-            return compileGroup([
-                    (compileToken, ['symbol', '{']),
-                    (compileVarDec, []),
-                    (compileStatements, []),
-                    (compileToken, ['symbol', '}'])
-                ])
-
-        
-
-        child_list = formBodyGr()
-        root = ET.Element('subroutineBody')
-        if child_list != []:
-            for child in child_list:
-                root.append(child)
-            return root
-        else:
-            root.text = '\r\n'
-            return root
-
-    def writeS(fn):
-        statements = fn()
-        return writeStatements(statements)
-
-    def writeStatements(statements):
-        if statements != None:
-            result = ''.join([writeSt(x) for x in statements])
-        return result
-
-    def genLabel(name=''):
-        global SUB_INDEX
-        try:
-            count = SUB_INDEX[name]
-        except KeyError:
-            count = 0
-            SUB_INDEX[name] = count
-        label = '{}{}'.format(name, count)
-        SUB_INDEX[name] += 1
-        return label
-
-    def writeSt(elem):
-        if elem.tag == 'letStatement':
-            let_check = elem[2]
-            if let_check.text == '=':
-                let_expression = writeExpr(elem.find('expression'))
-                let_ident = findVar(elem[1].text, CLASS_ST, SUB_ST)
-                if let_ident['category'] == 'field':
-                    var_segment = 'this'
-                else:
-                    var_segment = let_ident['category']
-                return '{}pop {} {}\n'.format(let_expression, var_segment, let_ident['index'])
-            elif let_check.text == '[':
-                expr1 = writeExpr(elem[3])
-                expr2 = writeExpr(elem[6])
-                let_ident = findVar(elem[1].text, CLASS_ST, SUB_ST)
-                if let_ident['category'] == 'field':
-                    var_segment = 'this'
-                else:
-                    var_segment = let_ident['category']
-                return 'push {} {}\n{}add\n{}pop temp 0\npop pointer 1\npush temp 0\npop that 0\n'.format(var_segment, let_ident['index'], expr1, expr2)
-
-            
-        elif elem.tag == 'doStatement':
-            return '{}pop temp 0\n'.format(writeSubCall(elem))
-        elif elem.tag == 'returnStatement':
-            expr = elem.find('expression')
-            if expr != None:
-                return '{}return\n'.format(writeExpr(expr))
-            else:
-               return('push constant 0\nreturn\n')
-        elif elem.tag == 'ifStatement':
-            result = ''
-            expr = elem.find('expression')
-            statements = elem.findall('statements')
-            if len(statements) == 1:
-                pos = statements[0]
-                neg = []
-                lab_if_true = genLabel('IF_TRUE')
-                lab_if_false = genLabel('IF_FALSE')
-            elif len(statements) == 2:
-                pos = statements[0]
-                neg = statements[1]
-                lab_if_true = genLabel('IF_TRUE')
-                lab_if_end = genLabel('IF_END')
-                lab_if_false = genLabel('IF_FALSE')
-            result = '{}if-goto {}\ngoto {}\n'.format(writeExpr(expr), lab_if_true, lab_if_false)
-            if neg != []:
-                result += 'label {}\n{}goto {}\nlabel {}\n{}label {}\n'.format(lab_if_true, writeStatements(pos),lab_if_end, lab_if_false, writeStatements(neg), lab_if_end)
-            else:
-                result += 'label {}\n{}label {}\n'.format(lab_if_true, writeStatements(pos), lab_if_false)
-            return result
-        elif elem.tag == 'whileStatement':
-            result = ''
-            expr = elem.find('expression')
-            statements = elem.find('statements')
-            label1 = genLabel('WHILE_EXP')
-            label2 = genLabel('WHILE_END')
-            result = 'label {}\n{}not\nif-goto {}\n{}goto {}\nlabel {}\n'.format(label1, writeExpr(expr), label2, writeStatements(statements), label1, label2)
-            return result
-        else:
-            return elem
+class LetStatement:
+    __slots__ = ('name', 'index', 'value')
 
+    def __init__(self, name, index, value):
+        self.name = name
+        self.index = index
+        self.value = value
 
-    def compileStatements():
-        def compileStatement():
-            stmnts = [compileLet, compileIf, compileWhile, compileDo, compileReturn]
-            for fn in stmnts:
-                try:
-                    elem = fn()
-                    if elem != None:
-                        return elem
-                except ValueError:
-                    continue
-            raise ValueError('Cannot parse')
-
-        def compileLet():
-            def formGroup1():
-                return compileGroup([
-                    (compileToken, ['symbol', '[']),
-                    (compileExpression, []),
-                    (compileToken, ['symbol', ']'])
-                ])
-
-            def compileSubExpr():
-                elem = compileZeroOrOne(formGroup1)
-                if elem != None:
-                    return elem
-                else:
-                    return []
-            
-            def compileLetVarName():
-                elem = compileToken('identifier', None)
-                return elem
-                # var = varDefined(elem.text)
-                # if var != None:
-                #     elem.attrib = var
-                #     elem.attrib['used'] = 'True'
-                #     return elem
-                # else:
-                #     raise SyntaxError('{} variable is not defined'.format(elem.text))
-
-
-            def formGroup2():
-                return compileGroup([
-                    (compileToken, ['keyword', 'let']),
-                    (compileLetVarName, []),
-                    (compileSubExpr, []),
-                    (compileToken, ['symbol', '=']),
-                    (compileExpression, []),
-                    (compileToken, ['symbol', ';'])
-                ])
-            child_list = formGroup2()
-
-            if child_list != []:
-                root = ET.Element('letStatement')
-                for child in child_list:
-                    root.append(child)
-                return root
-            else:
-                return []
-
-        def compileIf():
-
-            def formElseGroup():
-                return compileGroup([
-                    (compileToken, ['keyword', 'else']),
-                    (compileToken, ['symbol', '{']),
-                    (compileStatements, []),
-                    (compileToken, ['symbol', '}'])
-                ])
-
-            def compileElseExpr():
-                elem = compileZeroOrOne(formElseGroup)
-                if elem != None:
-                    return elem
-                else:
-                    return []
-            
-            def formGroup2():
-                return compileGroup([
-                    (compileToken, ['keyword', 'if']),
-                    (compileToken, ['symbol', '(']),
-                    (compileExpression, []),
-                    (compileToken, ['symbol', ')']),
-                    (compileToken, ['symbol', '{']),
-                    (compileStatements, []),
-                    (compileToken, ['symbol', '}']),
-                    (compileElseExpr, [])
-                ])
-
-            child_list = formGroup2()
-
-            if child_list != []:
-                root = ET.Element('ifStatement')
-                for child in child_list:
-                    root.append(child)
-                return root
-            else:
-                return []
-
-
-        def compileWhile():
-            def formGroup2():
-                return compileGroup([
-                    (compileToken, ['keyword', 'while']),
-                    (compileToken, ['symbol', '(']),
-                    (compileExpression, []),
-                    (compileToken, ['symbol', ')']),
-                    (compileToken, ['symbol', '{']),
-                    (compileStatements, []),
-                    (compileToken, ['symbol', '}'])
-                ])
-
-            child_list = formGroup2()
-
-            if child_list != []:
-                root = ET.Element('whileStatement')
-                for child in child_list:
-                    root.append(child)
-                return root
-            else:
-                return []
-
-        def compileDo():
-            def compileDoVarName():
-                elem = compileToken('identifier', None)
-                var = varDefined(elem.text)
-                if var != None:
-                    elem.attrib = var
-                    elem.attrib['used'] = 'True'
-                    return elem
-                else:
-                    return elem
-
-            def formGroup2():
-                return compileGroup([
-                    (compileToken, ['keyword', 'do']),
-                    (compileDoVarName, []),
-                    (compileSubCall, []),
-                    (compileToken, ['symbol', ';'])
-                ])
-
-            child_list = formGroup2()
-            if child_list != []:
-                root = ET.Element('doStatement')
-                for child in child_list:
-                    root.append(child)
-                return root
-            else:
-                return []
-
-        def compileReturn():
-            def compileRetExpr():
-                elem = compileZeroOrOne(compileExpression)
-                if elem != None:
-                    # CODE += writeExpr(elem)
-                    return elem
-                else:
-                    return []
-
-            def formGroup2():
-                return compileGroup([
-                    (compileToken, ['keyword', 'return']),
-                    (compileRetExpr, []),
-                    (compileToken, ['symbol', ';'])
-                ])
-
-            child_list = formGroup2()
-
-            if child_list != []:
-                root = ET.Element('returnStatement')
-                for child in child_list:
-                    root.append(child)
-                return root
-            else:
-                return []
-
-        child_list = compileZeroOrMore(compileStatement)
-        root = ET.Element('statements')
-        if child_list != []:
-            for child in child_list:
-                root.append(child)
-            return root
-        else:
-            root.text = '\r\n'
-            return root
+class IfStatement:
+    __slots__ = ('condition', 'statements', 'else_statements')
 
+    def __init__(self, condition, statements, else_statements):
+        self.condition = condition
+        self.statements = statements
+        self.else_statements = else_statements
 
-    def writeOp(elem, table):
-        result = table[elem.text]
-        return result
+class WhileStatement:
+    __slots__ = ('condition', 'statements')
 
-    def writeTermList(elem):
-        if len(elem) > 1:
-            result = '{}{}{}\n'.format(writeTerm(elem[0]),
-                            writeTermList(elem[2:]),
-                            writeOp(elem[1], OPS))
-        else:
-            result = '{}'.format(writeTerm(elem[0]))
-        return result
-
-    def writeTerm(elem):
-        if len(elem) == 1:
-            if elem[0].tag == 'integerConstant':
-                result = 'push constant {}\n'.format(elem[0].text)
-            elif elem[0].tag == 'identifier':
-                var = findVar(elem[0].text, CLASS_ST, SUB_ST)
-                if var['category'] == 'field':
-                    var_segment = 'this'
-                else:
-                    var_segment = var['category']
-                result = 'push {} {}\n'.format(var_segment, var['index'])
-                
-            elif elem[0].tag == 'keyword':
-                mapping = {'null': 'constant 0', 'true': 'constant 0\nnot', 'false': 'constant 0', 'this': 'pointer 0'}
-                result = 'push {}\n'.format(mapping[elem[0].text])
-            elif elem[0].tag == 'stringConstant':
-                string_size = len(elem[0].text)
-                result = 'push constant {}\ncall String.new 1\n'.format(string_size)
-                for letter in elem[0].text:
-                    result += 'push constant {}\ncall String.appendChar 2\n'.format(ord(letter))
-                return result
-            return result
-        elif len(elem) == 2:
-            return '{}{}\n'.format(writeTerm(elem[1]), writeOp(elem[0], UNOPS))
-        elif len(elem) == 3:
-            return writeExpr(elem[1])
-        elif len(elem) == 4:
-            if elem.find('expressionList') != None:
-                return writeSubCall(elem)
-            else:
-                arr =  findVar(elem.find('identifier').text, CLASS_ST, SUB_ST)
-                if arr['category'] == 'field':
-                    var_segment = 'this'
-                else:
-                    var_segment = arr['category']
-                result = 'push {} {}\n'.format(var_segment, arr['index'])
-                expr = writeExpr(elem.find('expression'))
-                result += '{}add\npop pointer 1\npush that 0\n'.format(expr)
-                return result
-        elif len(elem) == 6:
-            return writeSubCall(elem)
-
-    def writeExpr(elem):   
-        if len(elem) == 1:
-            return writeTerm(elem[0])
-        else:
-            return writeTermList(elem)
+    def __init__(self, condition, statements):
+        self.condition = condition
+        self.statements = statements
 
+class DoStatement:
+    __slots__ = ('call',)
 
-        
+    def __init__(self, call):
+        self.call = call
 
-    def compileExpression():
-        def formTerm():
-            terms = [compileIntConst, compileStrConst, compileKwdConst, formParGr, formUnaryGr,formIdentCase]
-            for fn in terms:
-                try:
-                    elem = fn()
-                    if elem != None:
-                        return elem
-                except ValueError:
-                    continue
-            raise ValueError('Cannot parse')
-
-        def compileTerm():
-            root = ET.Element('term')
-            elem = formTerm()
-            try:
-                elem.tag
-                root.append(elem)
-            except AttributeError:
-                root.extend(elem)
-            return root
-
-        def compileIntConst():
-            return compileToken('integerConstant', None)
-
-        def compileStrConst():
-            return compileToken('stringConstant', None)
-
-
-        def compileKwdConst():
-            return compileOrAlt([
-                (compileToken, ['keyword','true']),
-                (compileToken, ['keyword','false']),
-                (compileToken, ['keyword','null']),
-                (compileToken, ['keyword','this'])
-            ])
-        
-        def compileOp():
-            return compileOrAlt([
-                (compileToken, ['symbol','+']),
-                (compileToken, ['symbol','-']),
-                (compileToken, ['symbol','*']),
-                (compileToken, ['symbol','/']),
-                (compileToken, ['symbol','&']),
-                (compileToken, ['symbol','|']),
-                (compileToken, ['symbol','<']),
-                (compileToken, ['symbol','>']),
-                (compileToken, ['symbol','='])
-            ])
-
-        def compileUnaryOp():
-            return compileOrAlt([
-                (compileToken, ['symbol','~']),
-                (compileToken, ['symbol','-'])
-            ])
-
-        def formTermsGr():
-            def formGroup1():
-                return compileGroup([
-                    (compileOp, []),
-                    (compileTerm, [])
-                ])
-
-            return compileGroup([
-                (compileTerm, []),
-                (compileZeroOrMore, [formGroup1])
-            ])
-
-        def formParGr():
-            return compileGroup([
-                (compileToken, ['symbol','(']),
-                (compileExpression, []),
-                (compileToken, ['symbol',')']),
-            ])
-
-        def formUnaryGr():
-            return compileGroup([
-                (compileUnaryOp, []),
-                (compileTerm, [])
-            ])
-
-        def formIdentCase():
-            def formGroup1():
-                return compileGroup([
-                    (compileToken, ['symbol','[']),
-                    (compileExpression, []),
-                    (compileToken, ['symbol',']'])
-                ])
-
-            def compileExpVarName():
-                elem = compileToken('identifier', None)
-                var = varDefined(elem.text)
-                if var != None:
-                    elem.attrib = var
-                    elem.attrib['used'] = 'True'
-                    return elem
-                else:
-                    # raise SyntaxError('{} variable is not defined'.format(elem.text))
-                    return elem
-
-        
-            result = [compileExpVarName()]
-            cases = [formGroup1, compileSubCall]
-            for fn in cases:
-                try:
-                    elem = fn()
-                    if elem != []:
-                        result.extend(elem)
-                        return result
-                except ValueError:
-                    continue
-            return result
-
-    
-        child_list = formTermsGr()
-
-        if child_list != []:
-            root = ET.Element('expression')
-            for child in child_list:
-                root.append(child)
-            return root
+class ReturnStatement:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+class Expression:
+    # terms joined by ops, len(ops) == len(terms) - 1. An expression in
+    # parentheses is itself used as a term.
+    __slots__ = ('terms', 'ops')
+
+    def __init__(self, terms, ops):
+        self.terms = terms
+        self.ops = ops
+
+class IntegerConstant:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+class StringConstant:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+class KeywordConstant:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+class VarTerm:
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+class ArrayTerm:
+    __slots__ = ('name', 'index')
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+
+class UnaryOp:
+    __slots__ = ('op', 'term')
+
+    def __init__(self, op, term):
+        self.op = op
+        self.term = term
+
+class SubroutineCall:
+    # target is the class or variable before the dot, None for a call of a
+    # method of the current object
+    __slots__ = ('target', 'name', 'args')
+
+    def __init__(self, target, name, args):
+        self.target = target
+        self.name = name
+        self.args = args
+
+class ConstMultiply:
+    # term * factor as an add chain, only made by the -O folding stage
+    __slots__ = ('term', 'factor')
+
+    def __init__(self, term, factor):
+        self.term = term
+        self.factor = factor
+
+
+def parseClass(tokenizer):
+    # predictive recursive descent parser: every production is picked from
+    # the current token, nothing is tried and undone
+
+    def compileToken(expected_type, expected_text=None):
+        token_type, token_text = tokenizer.peek()
+        if (expected_type != token_type):
+            raise ValueError('Expeting type "{}", got type "{}" ({})'.format(expected_type, token_type, token_text))
+        if (expected_text != None) and (expected_text != token_text):
+            raise ValueError('Expeting {}, got {}'.format(expected_text, token_text))
+        tokenizer.advance()
+        return token_text
+
+    def nextIs(token_type, token_text, k=0):
+        return tokenizer.peek(k) == (token_type, token_text)
+
+    def compileClass():
+        compileToken('keyword', 'class')
+        name = compileToken('identifier')
+        compileToken('symbol', '{')
+        var_decs = []
+        while tokenizer.peek() in CLASS_VAR_KWDS:
+            var_decs.append(compileClassVarDec())
+        subroutines = []
+        while tokenizer.peek() in SUBROUTINE_KWDS:
+            subroutines.append(compileSubroutineDec())
+        compileToken('symbol', '}')
+        return ClassNode(name, var_decs, subroutines)
+
+    def compileVarNames():
+        names = [compileToken('identifier')]
+        while nextIs('symbol', ','):
+            compileToken('symbol', ',')
+            names.append(compileToken('identifier'))
+        return names
+
+    def compileClassVarDec():
+        category = compileToken('keyword')
+        var_type = compileType()
+        names = compileVarNames()
+        compileToken('symbol', ';')
+        return ClassVarDec(category, var_type, names)
+
+    def compileType():
+        token = tokenizer.peek()
+        if token in TYPE_KWDS:
+            return compileToken('keyword')
+        return compileToken('identifier')
+
+    def compileSubroutineDec():
+        kind = compileToken('keyword')
+        if nextIs('keyword', 'void'):
+            return_type = compileToken('keyword')
         else:
-            return []
-    
-    
+            return_type = compileType()
+        name = compileToken('identifier')
+        compileToken('symbol', '(')
+        params = []
+        if not nextIs('symbol', ')'):
+            params.append((compileType(), compileToken('identifier')))
+            while nextIs('symbol', ','):
+                compileToken('symbol', ',')
+                params.append((compileType(), compileToken('identifier')))
+        compileToken('symbol', ')')
+        compileToken('symbol', '{')
+        var_decs = []
+        while nextIs('keyword', 'var'):
+            compileToken('keyword', 'var')
+            var_type = compileType()
+            names = compileVarNames()
+            compileToken('symbol', ';')
+            var_decs.append(VarDec(var_type, names))
+        statements = compileStatements()
+        compileToken('symbol', '}')
+        return Subroutine(kind, return_type, name, params, var_decs, statements)
+
+    def compileStatements():
+        statements = []
+        while True:
+            token_type, token_text = tokenizer.peek()
+            if token_type != 'keyword' or token_text not in stmnts:
+                return statements
+            statements.append(stmnts[token_text]())
+
+    def compileLet():
+        compileToken('keyword', 'let')
+        name = compileToken('identifier')
+        index = None
+        if nextIs('symbol', '['):
+            compileToken('symbol', '[')
+            index = compileExpression()
+            compileToken('symbol', ']')
+        compileToken('symbol', '=')
+        value = compileExpression()
+        compileToken('symbol', ';')
+        return LetStatement(name, index, value)
+
+    def compileBlock():
+        compileToken('symbol', '{')
+        statements = compileStatements()
+        compileToken('symbol', '}')
+        return statements
+
+    def compileIf():
+        compileToken('keyword', 'if')
+        compileToken('symbol', '(')
+        condition = compileExpression()
+        compileToken('symbol', ')')
+        statements = compileBlock()
+        else_statements = None
+        if nextIs('keyword', 'else'):
+            compileToken('keyword', 'else')
+            else_statements = compileBlock()
+        return IfStatement(condition, statements, else_statements)
+
+    def compileWhile():
+        compileToken('keyword', 'while')
+        compileToken('symbol', '(')
+        condition = compileExpression()
+        compileToken('symbol', ')')
+        return WhileStatement(condition, compileBlock())
+
+    def compileDo():
+        compileToken('keyword', 'do')
+        call = compileSubCall(compileToken('identifier'))
+        compileToken('symbol', ';')
+        return DoStatement(call)
+
+    def compileReturn():
+        compileToken('keyword', 'return')
+        value = None
+        if not nextIs('symbol', ';'):
+            value = compileExpression()
+        compileToken('symbol', ';')
+        return ReturnStatement(value)
+
+    stmnts = {'let': compileLet,
+              'if': compileIf,
+              'while': compileWhile,
+              'do': compileDo,
+              'return': compileReturn}
+
+    def compileExpression():
+        terms = [compileTerm()]
+        ops = []
+        while True:
+            token_type, token_text = tokenizer.peek()
+            if token_type != 'symbol' or token_text not in OPS:
+                return Expression(terms, ops)
+            ops.append(compileToken('symbol'))
+            terms.append(compileTerm())
+
+    def compileTerm():
+        token_type, token_text = tokenizer.peek()
+        if token_type == 'integerConstant':
+            return IntegerConstant(compileToken(token_type))
+        elif token_type == 'stringConstant':
+            return StringConstant(compileToken(token_type))
+        elif token_type == 'keyword' and token_text in KEYWORD_CONSTANTS:
+            return KeywordConstant(compileToken(token_type))
+        elif token_type == 'symbol' and token_text == '(':
+            compileToken('symbol', '(')
+            expr = compileExpression()
+            compileToken('symbol', ')')
+            return expr
+        elif token_type == 'symbol' and token_text in UNOPS:
+            return UnaryOp(compileToken('symbol'), compileTerm())
+        elif token_type == 'identifier':
+            # the token after the name tells a[i], a.b(), a() and a apart
+            if nextIs('symbol', '[', 1):
+                name = compileToken('identifier')
+                compileToken('symbol', '[')
+                index = compileExpression()
+                compileToken('symbol', ']')
+                return ArrayTerm(name, index)
+            elif nextIs('symbol', '.', 1) or nextIs('symbol', '(', 1):
+                return compileSubCall(compileToken('identifier'))
+            return VarTerm(compileToken('identifier'))
+        raise ValueError('Expeting a term, got {}'.format(token_text))
+
     def compileExprList():
-            def formGroup1():
-                return compileGroup([
-                    (compileToken, ['symbol', ',']),
-                    (compileExpression, [])
-                ])
-            def formGroup2():
-                return compileGroup([
-                    (compileExpression, []),
-                    (compileZeroOrMore, [formGroup1])
-                ])
-            def formGroup3():
-               return compileZeroOrOne(formGroup2)
-            
-            child_list = formGroup3()
-            root = ET.Element('expressionList')
-            if child_list != None:
-                for child in child_list:
-                    root.append(child)
-                return root
-            else:
-                root.text = '\r\n'
-                return root
-        
-    
-    def writeSubCall(elem_list):
-        global COMP_CLASSES
-        result = ''
-        idents = elem_list.findall('identifier')
-        expr_list = elem_list.find('expressionList')
-        exprs = expr_list.findall('expression')
-        if exprs != []:
-            expr = ''.join([writeExpr(x) for x in exprs])
-        else:
-            expr = ''
-        if len(idents) == 1:
-            result += 'push pointer 0\n{}call {}.{} {}\n'.format(expr, CLASS_NAME, idents[0].text, len(exprs)+1)
+        exprs = []
+        if not nextIs('symbol', ')'):
+            exprs.append(compileExpression())
+            while nextIs('symbol', ','):
+                compileToken('symbol', ',')
+                exprs.append(compileExpression())
+        return exprs
+
+    def compileSubCall(target):
+        if nextIs('symbol', '.'):
+            compileToken('symbol', '.')
+            name = compileToken('identifier')
         else:
-            var = findVar(idents[0].text, CLASS_ST, SUB_ST)
-            if var == None and idents[0].text in COMP_CLASSES:
-                result += '{}call {} {}\n'.format(expr, '.'.join([i.text for i in idents]), len(exprs))
-            elif var != None:
-                if var['category'] == 'field':
-                    var_segment = 'this'
-                else:
-                    var_segment = var['category']
-                result += 'push {} {}\n'.format(var_segment, var['index'])
-                result += '{}call {}.{} {}\n'.format(expr, var['type'], idents[1].text, len(exprs)+1)
-            else:
-                result += '{}call {} {}\n'.format(expr, '.'.join([i.text for i in idents]), len(exprs))
-        return result
-
-
-    def compileSubCall():
-        def formGroup1():
-            return compileGroup([
-                (compileToken, ['symbol', '.']),
-                (compileToken, ['identifier', None]),
-                (compileToken, ['symbol','(']),
-                (compileExprList, []),
-                (compileToken, ['symbol',')']),
-            ])
-        
-        def formGroup2():
-                return compileGroup([
-                    (compileToken, ['symbol', '(']),
-                    (compileExprList, []),
-                    (compileToken, ['symbol',')']),
-                ])
-        
-        cases = [formGroup1, formGroup2]
-        for fn in cases:
-            try:
-                elem = fn()
-                if elem != []:
-                    return elem
-            except ValueError:
-                continue
-        raise ValueError('Cannot parse')
+            target, name = None, target
+        compileToken('symbol', '(')
+        args = compileExprList()
+        compileToken('symbol', ')')
+        return SubroutineCall(target, name, args)
 
     return compileClass()
 
-def writeFile(data, filename):
-    f = open('{name}.vm'.format(name=filename), 'w')
+
+def emit(command):
+    # appends a VmCommand record to the code of the class being written
+    VM_CODE.append(command)
+
+def writeClass(node):
+    # returns the VmCommand records of the class
+    global CLASS_NAME, VM_CODE
+    SYMBOL_TABLE.startClass()
+    for var_dec in node.var_decs:
+        for name in var_dec.names:
+            SYMBOL_TABLE.define(name, var_dec.type, var_dec.category)
+    CLASS_NAME = node.name
+    VM_CODE = []
+    for x in node.subroutines:
+        writeFunction(x)
+    return VM_CODE
+
+def writeFunction(node):
+    global CLASS_NAME, SUB_INDEX
+    SYMBOL_TABLE.startSubroutine()
+    SUB_INDEX = {'argument': 0,
+         'local':    0,
+         'name': '',
+         'label': 0}
+    if node.kind == 'method':
+        SYMBOL_TABLE.define('this', CLASS_NAME, 'argument')
+    for param_type, param_name in node.params:
+        SYMBOL_TABLE.define(param_name, param_type, 'argument')
+    CLASS_SIGNATURE.append('{} {} {}({})'.format(node.kind, node.return_type, node.name,
+                                                 ','.join([x for x, _ in node.params])))
+    for var_dec in node.var_decs:
+        for var_name in var_dec.names:
+            SYMBOL_TABLE.define(var_name, var_dec.type, 'local')
+    locals_count = SYMBOL_TABLE.varCount('local')
+    emit(VmCommand(FUNCTION, None, locals_count, '{}.{}'.format(CLASS_NAME, node.name)))
+    if node.kind == 'constructor':
+        field_count = SYMBOL_TABLE.varCount('field')
+        emit(VmCommand(PUSH, CONSTANT, field_count))
+        emit(VmCommand(CALL, None, 1, 'Memory.alloc'))
+        emit(VmCommand(POP, POINTER, 0))
+    if node.kind == 'method':
+        emit(VmCommand(PUSH, ARGUMENT, 0))
+        emit(VmCommand(POP, POINTER, 0))
+    writeStatements(node.statements)
+
+def writeStatements(statements):
+    for x in statements:
+        writeSt(x)
+
+def genLabel(name=''):
+    global SUB_INDEX
+    try:
+        count = SUB_INDEX[name]
+    except KeyError:
+        count = 0
+        SUB_INDEX[name] = count
+    label = '{}{}'.format(name, count)
+    SUB_INDEX[name] += 1
+    return label
+
+def writeSt(node):
+    node_type = type(node)
+    if node_type is LetStatement:
+        let_ident = findVar(node.name)
+        if node.index == None:
+            writeExpr(node.value)
+            emit(VmCommand(POP, let_ident.segment, let_ident.index))
+        else:
+            emit(VmCommand(PUSH, let_ident.segment, let_ident.index))
+            writeExpr(node.index)
+            emit(ADD_COMMAND)
+            writeExpr(node.value)
+            emit(VmCommand(POP, TEMP, 0))
+            emit(VmCommand(POP, POINTER, 1))
+            emit(VmCommand(PUSH, TEMP, 0))
+            emit(VmCommand(POP, THAT, 0))
+    elif node_type is DoStatement:
+        writeSubCall(node.call)
+        emit(VmCommand(POP, TEMP, 0))
+    elif node_type is ReturnStatement:
+        if node.value != None:
+            writeExpr(node.value)
+        else:
+            emit(PUSH_ZERO)
+        emit(VmCommand(RETURN))
+    elif node_type is IfStatement:
+        if node.else_statements == None:
+            lab_if_true = genLabel('IF_TRUE')
+            lab_if_false = genLabel('IF_FALSE')
+        else:
+            lab_if_true = genLabel('IF_TRUE')
+            lab_if_end = genLabel('IF_END')
+            lab_if_false = genLabel('IF_FALSE')
+        writeExpr(node.condition)
+        emit(VmCommand(IF_GOTO, None, 0, lab_if_true))
+        emit(VmCommand(GOTO, None, 0, lab_if_false))
+        emit(VmCommand(LABEL, None, 0, lab_if_true))
+        writeStatements(node.statements)
+        if node.else_statements != None:
+            emit(VmCommand(GOTO, None, 0, lab_if_end))
+            emit(VmCommand(LABEL, None, 0, lab_if_false))
+            writeStatements(node.else_statements)
+            emit(VmCommand(LABEL, None, 0, lab_if_end))
+        else:
+            emit(VmCommand(LABEL, None, 0, lab_if_false))
+    elif node_type is WhileStatement:
+        label1 = genLabel('WHILE_EXP')
+        label2 = genLabel('WHILE_END')
+        emit(VmCommand(LABEL, None, 0, label1))
+        writeExpr(node.condition)
+        emit(NOT_COMMAND)
+        emit(VmCommand(IF_GOTO, None, 0, label2))
+        writeStatements(node.statements)
+        emit(VmCommand(GOTO, None, 0, label1))
+        emit(VmCommand(LABEL, None, 0, label2))
+
+def writeTermList(terms, ops):
+    # right-associative: t0 op (t1 op (t2 ...))
+    writeTerm(terms[0])
+    if len(terms) > 1:
+        writeTermList(terms[1:], ops[1:])
+        emit(OP_COMMANDS[ops[0]])
+
+def writeTerm(node):
+    node_type = type(node)
+    if node_type is IntegerConstant:
+        emit(VmCommand(PUSH, CONSTANT, int(node.value)))
+    elif node_type is VarTerm:
+        var = findVar(node.name)
+        emit(VmCommand(PUSH, var.segment, var.index))
+    elif node_type is KeywordConstant:
+        if node.value == 'this':
+            emit(VmCommand(PUSH, POINTER, 0))
+        else:
+            emit(PUSH_ZERO)
+            if node.value == 'true':
+                emit(NOT_COMMAND)
+    elif node_type is StringConstant:
+        emit(VmCommand(PUSH, CONSTANT, len(node.value)))
+        emit(VmCommand(CALL, None, 1, 'String.new'))
+        for letter in node.value:
+            emit(VmCommand(PUSH, CONSTANT, ord(letter)))
+            emit(VmCommand(CALL, None, 2, 'String.appendChar'))
+    elif node_type is UnaryOp:
+        writeTerm(node.term)
+        emit(UNOP_COMMANDS[node.op])
+    elif node_type is Expression:
+        writeExpr(node)
+    elif node_type is SubroutineCall:
+        writeSubCall(node)
+    elif node_type is ArrayTerm:
+        arr = findVar(node.name)
+        emit(VmCommand(PUSH, arr.segment, arr.index))
+        writeExpr(node.index)
+        emit(ADD_COMMAND)
+        emit(VmCommand(POP, POINTER, 1))
+        emit(VmCommand(PUSH, THAT, 0))
+    elif node_type is ConstMultiply:
+        # double the product for every bit of the factor after the first and
+        # add the term, kept in temp 1, for every set bit
+        bits = bin(node.factor)[3:]
+        writeTerm(node.term)
+        if '1' in bits:
+            emit(VmCommand(POP, TEMP, 1))
+            emit(VmCommand(PUSH, TEMP, 1))
+        for bit in bits:
+            emit(VmCommand(POP, TEMP, 2))
+            emit(VmCommand(PUSH, TEMP, 2))
+            emit(VmCommand(PUSH, TEMP, 2))
+            emit(ADD_COMMAND)
+            if bit == '1':
+                emit(VmCommand(PUSH, TEMP, 1))
+                emit(ADD_COMMAND)
+
+def writeExpr(node):
+    if len(node.terms) == 1:
+        writeTerm(node.terms[0])
+    else:
+        writeTermList(node.terms, node.ops)
+
+def writeSubCall(node):
+    exprs = node.args
+    if node.target == None:
+        emit(VmCommand(PUSH, POINTER, 0))
+        for x in exprs:
+            writeExpr(x)
+        emit(VmCommand(CALL, None, len(exprs)+1, '{}.{}'.format(CLASS_NAME, node.name)))
+    else:
+        var = findVar(node.target)
+        CLASS_DEPENDS.add(node.target if var == None else var.type)
+        if var != None:
+            emit(VmCommand(PUSH, var.segment, var.index))
+        for x in exprs:
+            writeExpr(x)
+        if var != None:
+            emit(VmCommand(CALL, None, len(exprs)+1, '{}.{}'.format(var.type, node.name)))
+        else:
+            emit(VmCommand(CALL, None, len(exprs), '{}.{}'.format(node.target, node.name)))
+
+def wrapWord(value):
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+def constValue(node):
+    # value of a constant term, None for anything else
+    node_type = type(node)
+    if node_type is IntegerConstant:
+        return wrapWord(int(node.value))
+    elif node_type is KeywordConstant and node.value != 'this':
+        return -1 if node.value == 'true' else 0
+    elif node_type is UnaryOp:
+        value = constValue(node.term)
+        if value != None:
+            return wrapWord(-value if node.op == '-' else ~value)
+    return None
+
+def constTerm(value):
+    if value == -1:
+        return KeywordConstant('true')
+    elif value >= 0:
+        return IntegerConstant(str(value))
+    elif value > -0x8000:
+        return UnaryOp('-', IntegerConstant(str(-value)))
+    else:
+        return UnaryOp('~', IntegerConstant(str(~value)))
+
+def foldConst(op, a, b):
+    # value of a op b as the Hack VM and Math would compute it, None where
+    # that is not certain
+    if op in '<>=':
+        # lt and gt compare through a subtraction that must not overflow
+        if wrapWord(a - b) != a - b:
+            return None
+        return -({'<': a < b, '>': a > b, '=': a == b}[op])
+    elif op == '/':
+        if b == 0 or a == -0x8000 or b == -0x8000:
+            return None
+        quotient = abs(a) // abs(b)
+        return quotient if (a < 0) == (b < 0) else -quotient
+    return wrapWord({'+': a + b, '-': a - b, '*': a * b, '&': a & b, '|': a | b}[op])
+
+def foldBinary(op, left, right):
+    # left op right with constant operands folded, identities dropped and
+    # small constant multiplies turned into add chains
+    a = constValue(left)
+    b = constValue(right)
+    if a != None and b != None:
+        value = foldConst(op, a, b)
+        if value != None:
+            return constTerm(value)
+    if op in '+|' and b == 0 or op == '-' and b == 0 or op in '*/' and b == 1 or op == '&' and b == -1:
+        return left
+    if op in '+|' and a == 0 or op == '*' and a == 1 or op == '&' and a == -1:
+        return right
+    if op == '-' and a == 0:
+        return UnaryOp('-', right)
+    if op == '*' and b != None and 2 <= b <= MUL_CHAIN_MAX:
+        return ConstMultiply(left, b)
+    if op == '*' and a != None and 2 <= a <= MUL_CHAIN_MAX:
+        return ConstMultiply(right, a)
+    return Expression([left, right], [op])
+
+def foldTermList(terms, ops):
+    # the right-associative reading of writeTermList: t0 op (t1 op (t2 ...))
+    left = foldTerm(terms[0])
+    if len(terms) == 1:
+        return left
+    return foldBinary(ops[0], left, foldTermList(terms[1:], ops[1:]))
+
+def foldTerm(node):
+    node_type = type(node)
+    if node_type is Expression:
+        return foldTermList(node.terms, node.ops)
+    elif node_type is UnaryOp:
+        node.term = foldTerm(node.term)
+        value = constValue(node)
+        return node if value == None else constTerm(value)
+    elif node_type is ArrayTerm:
+        node.index = foldExpr(node.index)
+    elif node_type is SubroutineCall:
+        node.args = [foldExpr(x) for x in node.args]
+    return node
+
+def foldExpr(node):
+    term = foldTerm(node)
+    return term if type(term) is Expression else Expression([term], [])
+
+def foldStatements(statements):
+    for node in statements:
+        node_type = type(node)
+        if node_type is LetStatement:
+            if node.index != None:
+                node.index = foldExpr(node.index)
+            node.value = foldExpr(node.value)
+        elif node_type is DoStatement:
+            foldTerm(node.call)
+        elif node_type is ReturnStatement:
+            if node.value != None:
+                node.value = foldExpr(node.value)
+        elif node_type is IfStatement:
+            node.condition = foldExpr(node.condition)
+            foldStatements(node.statements)
+            if node.else_statements != None:
+                foldStatements(node.else_statements)
+        elif node_type is WhileStatement:
+            node.condition = foldExpr(node.condition)
+            foldStatements(node.statements)
+
+def foldClass(node):
+    # -O: fold constant subexpressions of the parse tree in place
+    for subroutine in node.subroutines:
+        foldStatements(subroutine.statements)
+
+def peepholeTail(out):
+    # rewrites the end of the command list, returns True if it changed
+    last = out[-1]
+    op = last.op
+    prev = out[-2] if len(out) > 1 else NO_COMMAND
+    if op in (NOT, NEG) and prev == last:
+        del out[-2:]
+    elif op == NEG and prev == PUSH_ZERO:
+        del out[-1]
+    elif op == POP and prev.op == PUSH and prev[1:] == last[1:]:
+        del out[-2:]
+    elif last in CONST_FOLDS and len(out) > 2 and out[-3][:2] == prev[:2] == PUSH_CONSTANT:
+        value = CONST_FOLDS[last](out[-3].index, prev.index)
+        if value == -1:
+            out[-3:] = [PUSH_ZERO, NOT_COMMAND]
+        elif value != None and 0 <= value <= 0x7FFF:
+            out[-3:] = [VmCommand(PUSH, CONSTANT, value)]
+        else:
+            return False
+    elif op == IF_GOTO and prev[:2] == PUSH_CONSTANT:
+        # constant condition: never or always taken
+        if prev.index == 0:
+            del out[-2:]
+        else:
+            out[-2:] = [VmCommand(GOTO, None, 0, last.name)]
+    elif op == IF_GOTO and prev == NOT_COMMAND and len(out) > 2 and out[-3] == PUSH_ZERO:
+        out[-3:] = [VmCommand(GOTO, None, 0, last.name)]
+    elif op == LABEL:
+        tail = out[-5:]
+        if (len(tail) == 5 and tail[0] in BOOLEAN_COMMANDS and tail[1] == NOT_COMMAND
+              and tail[2] == VmCommand(IF_GOTO, None, 0, last.name) and tail[3].op == GOTO):
+            # not/if-goto L1/goto L2/label L1 on a 0 or -1 condition is if-goto L2/label L1
+            out[-4:] = [VmCommand(IF_GOTO, None, 0, tail[3].name), last]
+            return True
+        # a goto to a label that directly follows it
+        i = len(out) - 1
+        while i > 0 and out[i - 1].op == LABEL:
+            i -= 1
+        if i > 0 and out[i - 1].op == GOTO and VmCommand(LABEL, None, 0, out[i - 1].name) in out[i:]:
+            del out[i - 1]
+        else:
+            return False
+    else:
+        return False
+    return True
+
+def peephole(commands):
+    # -O: the VmCommand records are rewritten as they are appended
+    out = []
+    for command in commands:
+        out.append(command)
+        while out and peepholeTail(out):
+            pass
+    return out
+
+# XML serializer, in the format written by syntax_anl.py
+
+def xmlToken(parent, token_type, text):
+    elem = ET.SubElement(parent, token_type)
+    elem.text = ' {} '.format(text)
+
+def xmlType(parent, type_name):
+    xmlToken(parent, 'keyword' if type_name in KEYWORD_SET else 'identifier', type_name)
+
+def xmlNames(parent, names):
+    for i, name in enumerate(names):
+        if i:
+            xmlToken(parent, 'symbol', ',')
+        xmlToken(parent, 'identifier', name)
+
+def xmlStatements(parent, statements):
+    root = ET.SubElement(parent, 'statements')
+    if statements == []:
+        root.text = '\r\n'
+    for node in statements:
+        node_type = type(node)
+        if node_type is LetStatement:
+            elem = ET.SubElement(root, 'letStatement')
+            xmlToken(elem, 'keyword', 'let')
+            xmlToken(elem, 'identifier', node.name)
+            if node.index != None:
+                xmlToken(elem, 'symbol', '[')
+                xmlExpression(elem, node.index)
+                xmlToken(elem, 'symbol', ']')
+            xmlToken(elem, 'symbol', '=')
+            xmlExpression(elem, node.value)
+            xmlToken(elem, 'symbol', ';')
+        elif node_type is IfStatement:
+            elem = ET.SubElement(root, 'ifStatement')
+            xmlToken(elem, 'keyword', 'if')
+            xmlToken(elem, 'symbol', '(')
+            xmlExpression(elem, node.condition)
+            xmlToken(elem, 'symbol', ')')
+            xmlToken(elem, 'symbol', '{')
+            xmlStatements(elem, node.statements)
+            xmlToken(elem, 'symbol', '}')
+            if node.else_statements != None:
+                xmlToken(elem, 'keyword', 'else')
+                xmlToken(elem, 'symbol', '{')
+                xmlStatements(elem, node.else_statements)
+                xmlToken(elem, 'symbol', '}')
+        elif node_type is WhileStatement:
+            elem = ET.SubElement(root, 'whileStatement')
+            xmlToken(elem, 'keyword', 'while')
+            xmlToken(elem, 'symbol', '(')
+            xmlExpression(elem, node.condition)
+            xmlToken(elem, 'symbol', ')')
+            xmlToken(elem, 'symbol', '{')
+            xmlStatements(elem, node.statements)
+            xmlToken(elem, 'symbol', '}')
+        elif node_type is DoStatement:
+            elem = ET.SubElement(root, 'doStatement')
+            xmlToken(elem, 'keyword', 'do')
+            xmlSubCall(elem, node.call)
+            xmlToken(elem, 'symbol', ';')
+        elif node_type is ReturnStatement:
+            elem = ET.SubElement(root, 'returnStatement')
+            xmlToken(elem, 'keyword', 'return')
+            if node.value != None:
+                xmlExpression(elem, node.value)
+            xmlToken(elem, 'symbol', ';')
+
+def xmlExpression(parent, node):
+    root = ET.SubElement(parent, 'expression')
+    xmlTerm(root, node.terms[0])
+    for op, term in zip(node.ops, node.terms[1:]):
+        xmlToken(root, 'symbol', op)
+        xmlTerm(root, term)
+
+def xmlTerm(parent, node):
+    root = ET.SubElement(parent, 'term')
+    node_type = type(node)
+    if node_type is IntegerConstant:
+        xmlToken(root, 'integerConstant', node.value)
+    elif node_type is StringConstant:
+        xmlToken(root, 'stringConstant', node.value)
+    elif node_type is KeywordConstant:
+        xmlToken(root, 'keyword', node.value)
+    elif node_type is VarTerm:
+        xmlToken(root, 'identifier', node.name)
+    elif node_type is ArrayTerm:
+        xmlToken(root, 'identifier', node.name)
+        xmlToken(root, 'symbol', '[')
+        xmlExpression(root, node.index)
+        xmlToken(root, 'symbol', ']')
+    elif node_type is UnaryOp:
+        xmlToken(root, 'symbol', node.op)
+        xmlTerm(root, node.term)
+    elif node_type is Expression:
+        xmlToken(root, 'symbol', '(')
+        xmlExpression(root, node)
+        xmlToken(root, 'symbol', ')')
+    elif node_type is SubroutineCall:
+        xmlSubCall(root, node)
+
+def xmlSubCall(parent, node):
+    if node.target != None:
+        xmlToken(parent, 'identifier', node.target)
+        xmlToken(parent, 'symbol', '.')
+    xmlToken(parent, 'identifier', node.name)
+    xmlToken(parent, 'symbol', '(')
+    root = ET.SubElement(parent, 'expressionList')
+    if node.args == []:
+        root.text = '\r\n'
+    for i, expr in enumerate(node.args):
+        if i:
+            xmlToken(root, 'symbol', ',')
+        xmlExpression(root, expr)
+    xmlToken(parent, 'symbol', ')')
+
+def writeXml(node):
+    root = ET.Element('class')
+    xmlToken(root, 'keyword', 'class')
+    xmlToken(root, 'identifier', node.name)
+    xmlToken(root, 'symbol', '{')
+    for var_dec in node.var_decs:
+        elem = ET.SubElement(root, 'classVarDec')
+        xmlToken(elem, 'keyword', var_dec.category)
+        xmlType(elem, var_dec.type)
+        xmlNames(elem, var_dec.names)
+        xmlToken(elem, 'symbol', ';')
+    for sub in node.subroutines:
+        elem = ET.SubElement(root, 'subroutineDec')
+        xmlToken(elem, 'keyword', sub.kind)
+        xmlType(elem, sub.return_type)
+        xmlToken(elem, 'identifier', sub.name)
+        xmlToken(elem, 'symbol', '(')
+        params = ET.SubElement(elem, 'parameterList')
+        if sub.params == []:
+            params.text = '\r\n'
+        for i, (param_type, param_name) in enumerate(sub.params):
+            if i:
+                xmlToken(params, 'symbol', ',')
+            xmlType(params, param_type)
+            xmlToken(params, 'identifier', param_name)
+        xmlToken(elem, 'symbol', ')')
+        body = ET.SubElement(elem, 'subroutineBody')
+        xmlToken(body, 'symbol', '{')
+        for var_dec in sub.var_decs:
+            dec = ET.SubElement(body, 'varDec')
+            xmlToken(dec, 'keyword', 'var')
+            xmlType(dec, var_dec.type)
+            xmlNames(dec, var_dec.names)
+            xmlToken(dec, 'symbol', ';')
+        xmlStatements(body, sub.statements)
+        xmlToken(body, 'symbol', '}')
+    xmlToken(root, 'symbol', '}')
+    return ET.tostring(root, encoding='unicode', method='xml')
+
+def writeFile(data, filename, extension='vm'):
+    f = open('{name}.{ext}'.format(name=filename, ext=extension), 'w')
     f.write(data)
     f.close()
 
 
 
-def parse(path):
+def resetState():
+    # fresh per-compilation state, so each class compiles the same way
+    # whatever was compiled before it, in this process or another one
+    global SYMBOL_TABLE, SUB_INDEX, CLASS_NAME, CLASS_SIGNATURE, CLASS_DEPENDS
+    SYMBOL_TABLE = SymbolTable()
+    SUB_INDEX = {'argument': 0,
+                 'local':    0,
+                 'name': '',
+                 'label': 0}
+    CLASS_NAME = ''
+    CLASS_SIGNATURE = []
+    CLASS_DEPENDS = set()
+
+def phaseTimer(profile):
+    # records the time since the previous call under each phase name in
+    # profile['phases'], a None phase is not recorded; does nothing when not
+    # profiling
+    if profile is None:
+        return lambda phase: None
+    profile['phases'] = {}
+    last = [time.perf_counter()]
+    def timer(phase):
+        now = time.perf_counter()
+        if phase:
+            profile['phases'][phase] = now - last[0]
+        last[0] = now
+    return timer
+
+def countNodes(node, counts):
+    counts[type(node).__name__] = counts.get(type(node).__name__, 0) + 1
+    for slot in node.__slots__:
+        value = getattr(node, slot)
+        for child in (value if isinstance(value, list) else [value]):
+            if hasattr(child, '__slots__'):
+                countNodes(child, counts)
+    return counts
+
+def compileCommands(path, xml=False, token_cache=False, optimize=False, profile=None):
+    # returns the VmCommand records of the class with its exported subroutine
+    # signature, the classes whose subroutines it calls and, if asked for, its
+    # parse tree as XML. A profile dict is filled with the phase times and
+    # sizes of the class
+    resetState()
+    timer = phaseTimer(profile)
+    if token_cache:
+        tokens = cachedTokens(path, tokenize)
+    else:
+        with open(path, mode='rb') as f:
+            source = f.read()
+        timer('read')
+        tokens = tokenize(source)
+    timer('tokenize')
+    tokenizer = tokenIterator(tokens)
+    class_node = parseClass(tokenizer)
+    timer('parse')
+    xml_data = writeXml(class_node) if xml else None
+    if xml:
+        timer('xml')
+    if profile is not None:
+        profile.update(tokens=len(tokens), nodes=countNodes(class_node, {}))
+        timer(None)
+    if optimize:
+        foldClass(class_node)
+        timer('fold')
+    commands = writeClass(class_node)
+    timer('write')
+    if optimize:
+        commands = peephole(commands)
+        timer('peephole')
+    return commands, CLASS_SIGNATURE, sorted(CLASS_DEPENDS - {CLASS_NAME}), xml_data
+
+def compileFile(path, xml=False, token_cache=False, optimize=False, profile=None):
+    # compileCommands with the VM code as text
+    commands, signature, depends, xml_data = compileCommands(path, xml, token_cache, optimize, profile)
+    start = time.perf_counter()
+    parsed_data = formatVm(commands)
+    if profile is not None:
+        profile['phases']['format'] = time.perf_counter() - start
+        profile.update(vm_commands=len(commands), vm_bytes=len(parsed_data))
+    return parsed_data, signature, depends, xml_data
+
+def compileFiles(files, jobs=1, xml=False, token_cache=False, optimize=False):
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            return dict(zip(files, pool.map(functools.partial(compileFile, xml=xml, token_cache=token_cache, optimize=optimize), files)))
+    else:
+        return {fl: compileFile(fl, xml, token_cache, optimize) for fl in files}
+
+def sourceHash(path):
+    return hashlib.sha1(path.read_bytes()).hexdigest()
+
+def loadCache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def saveCache(cache, path):
+    with open(path, 'w') as f:
+        json.dump(cache, f)
+
+def writeOutput(parsed_data, xml_data, filename):
+    writeFile(parsed_data, filename)
+    if xml_data != None:
+        writeFile(xml_data, filename, 'xml')
+
+def profileTotals(profiles):
+    totals = {'tokens': 0, 'vm_commands': 0, 'vm_bytes': 0, 'phases': {}, 'nodes': {}}
+    for prof in profiles.values():
+        for key in ('tokens', 'vm_commands', 'vm_bytes'):
+            totals[key] += prof[key]
+        for group in ('phases', 'nodes'):
+            for name, value in prof[group].items():
+                totals[group][name] = totals[group].get(name, 0) + value
+    return totals
+
+def profileReport(profiles):
+    # one row per class, phase times in milliseconds
+    phases = [phase for phase in PROFILE_PHASES if any(phase in prof['phases'] for prof in profiles.values())]
+    header = ['class', 'tokens', 'nodes'] + phases + ['vm cmds', 'vm bytes']
+    rows = []
+    for name, prof in list(profiles.items()) + [('total', profileTotals(profiles))]:
+        rows.append([name, prof['tokens'], sum(prof['nodes'].values())]
+                    + ['{:.2f}'.format(prof['phases'].get(phase, 0) * 1000) for phase in phases]
+                    + [prof['vm_commands'], prof['vm_bytes']])
+    width = max(len(row[0]) for row in rows + [header])
+    lines = []
+    for row in [header] + rows:
+        lines.append(row[0].ljust(width) + ''.join(str(cell).rjust(max(len(title), 8) + 2)
+                                                   for cell, title in zip(row[1:], header[1:])))
+    return '\n'.join(lines)
+
+def writeProfile(profiles, filename):
+    with open('{name}.profile.json'.format(name=filename), 'w') as f:
+        json.dump({'classes': profiles, 'totals': profileTotals(profiles)}, f, indent=2)
+    print('Profile written to {name}.profile.json'.format(name=filename))
+
+def parse(path, xml=False, token_cache=False, optimize=False, profile=False):
     p = Path(path)
     FILE['name'] = p.stem
     print('Opening single file %s' % FILE['name'])
-    parsed_data = ''
-    COMP_CLASSES.extend(OS_CLASSES)
-    with open(p, mode='rb') as f:
-        tokenizer = tokenIterator(f)
-        parsed_data = compile(tokenizer)
-    writeFile(parsed_data, FILE['name'])
-
-def parsedir(path):
+    prof = {} if profile else None
+    parsed_data, signature, depends, xml_data = compileFile(p, xml, token_cache, optimize, prof)
+    start = time.perf_counter()
+    writeOutput(parsed_data, xml_data, FILE['name'])
+    if profile:
+        prof['phases']['output'] = time.perf_counter() - start
+        print(profileReport({FILE['name']: prof}))
+        writeProfile({FILE['name']: prof}, FILE['name'])
+
+def parsedir(path, jobs=1, xml=False, token_cache=False, optimize=False, profile=False):
+    p = Path(path)
+    FILE['dir'] = p.name
+    files = list(p.glob('*.jack'))
+    profiles = {}
+    if jobs > 1:
+        for fl, (parsed_data, signature, depends, xml_data) in compileFiles(files, jobs, xml, token_cache, optimize).items():
+            FILE['name'] = fl.stem
+            print('Compiled dir file %s' % FILE['name'])
+            writeOutput(parsed_data, xml_data, FILE['name'])
+    else:
+        for fl in files:
+            FILE['name'] = fl.stem
+            print('Opening dir file %s' % FILE['name'])
+            prof = {} if profile else None
+            parsed_data, signature, depends, xml_data = compileFile(fl, xml, token_cache, optimize, prof)
+            start = time.perf_counter()
+            writeOutput(parsed_data, xml_data, FILE['name'])
+            if profile:
+                prof['phases']['output'] = time.perf_counter() - start
+                profiles[FILE['name']] = prof
+    if profile:
+        print(profileReport(profiles))
+        writeProfile(profiles, FILE['dir'])
+
+def parsedirIncremental(path, jobs=1, token_cache=False, optimize=False):
+    # recompile only the classes whose source hash changed, plus the classes
+    # calling into a class whose signature changed or that was removed.
+    # Everything else is written from the cache kept in CACHE_FILE.
     p = Path(path)
     FILE['dir'] = p.name
-    parsed_data = ''
-    FILE['name'] = 'Sys'
-    for fl in p.glob('*.jack'):
-        FILE['name'] = fl.stem
-        print('Opening dir file %s' % FILE['name'])
-        with open(fl, mode='rb') as f:
-            tokenizer = tokenIterator(f)
-            parsed_data = compile(tokenizer)
-        writeFile(parsed_data, FILE['name'])    
+    cache_path = p / CACHE_FILE
+    cache = loadCache(cache_path)
+    files = {fl.stem: fl for fl in p.glob('*.jack')}
+    hashes = {name: sourceHash(fl) for name, fl in files.items()}
+    # a class compiled with other optimization settings is compiled again
+    changed = [name for name in files
+               if cache.get(name, {}).get('hash') != hashes[name] or cache[name].get('optimize', False) != optimize]
+    results = compileFiles([files[name] for name in changed], jobs, token_cache=token_cache, optimize=optimize)
+    changed_sigs = {name for name in cache if name not in files}
+    for name in changed:
+        parsed_data, signature, depends, xml_data = results[files[name]]
+        if cache.get(name, {}).get('signature') != signature:
+            changed_sigs.add(name)
+        cache[name] = {'hash': hashes[name], 'vm': parsed_data, 'signature': signature, 'depends': depends,
+                       'optimize': optimize}
+    dependents = [name for name in files
+                  if name not in changed and changed_sigs.intersection(cache[name]['depends'])]
+    results = compileFiles([files[name] for name in dependents], jobs, token_cache=token_cache, optimize=optimize)
+    for name in dependents:
+        parsed_data, signature, depends, xml_data = results[files[name]]
+        cache[name].update({'vm': parsed_data, 'signature': signature, 'depends': depends})
+    for name in list(cache):
+        if name not in files:
+            del cache[name]
+    for name in files:
+        FILE['name'] = name
+        if name in changed or name in dependents:
+            print('Compiled dir file %s' % name)
+        writeFile(cache[name]['vm'], name)
+    saveCache(cache, cache_path)
 
 def main ():
     argparser = argparse.ArgumentParser(description='Produce xml from JACK program')
     argparser.add_argument('input')
+    argparser.add_argument('-j', '--jobs', type=int, default=1, help='number of classes to compile in parallel')
+    argparser.add_argument('--incremental', action='store_true',
+                           help='only recompile changed classes, using the build cache in the source directory')
+    argparser.add_argument('--xml', action='store_true', help='also write the parse tree of each class as xml')
+    argparser.add_argument('--token-cache', action='store_true',
+                           help='read tokens from the .tokens cache next to each source file, shared with syntax_anl.py')
+    argparser.add_argument('-O', dest='optimize', action='store_true',
+                           help='fold constant expressions, turn multiplies by small constants into add chains '
+                                'and run the peephole optimizer over the generated VM code')
+    argparser.add_argument('--profile', action='store_true',
+                           help='print phase times, token and node counts and output size per class, and write them as JSON')
     args = argparser.parse_args()
+    if args.xml and args.incremental:
+        argparser.error('--xml is not supported with --incremental')
+    if args.profile and (args.incremental or args.jobs > 1):
+        argparser.error('--profile is not supported with --incremental or --jobs')
     if os.path.isfile(args.input):
-        parse(args.input)
+        parse(args.input, args.xml, args.token_cache, args.optimize, args.profile)
+    elif os.path.isdir(args.input) and args.incremental:
+        parsedirIncremental(args.input, args.jobs, args.token_cache, args.optimize)
     elif os.path.isdir(args.input):
-        parsedir(args.input)
+        parsedir(args.input, args.jobs, args.xml, args.token_cache, args.optimize, args.profile)
     else:
         print('Path error')
         return None
@@ -1,6 +1,12 @@
 import argparse
 import re
 import os
+import sys
+import functools
+import itertools
+import tempfile
+from array import array
+from collections import namedtuple
 
 SYMBOL_TABLE = {
     'R0':     0,
@@ -82,71 +88,295 @@ COMP_TABLE = {
     'D|M': '1010101'
 }
 
-def writeFile(data, filename):
-    f = open('{name}.hack'.format(name=filename.split('.')[0]), 'w')
-    f.write(data)
+# integer field values of the C-instruction tables, shifted into place
+COMP_CODES = {comp: int(bits, 2) << 6 for comp, bits in COMP_TABLE.items()}
+DEST_CODES = {dest: int(bits, 2) << 3 for dest, bits in DEST_TABLE.items()}
+JUMP_CODES = {jump: int(bits, 2) for jump, bits in JUMP_TABLE.items()}
+COMP_NAMES = {code: comp for comp, code in COMP_CODES.items()}
+DEST_NAMES = {code: dest for dest, code in DEST_CODES.items()}
+JUMP_NAMES = {code: jump for jump, code in JUMP_CODES.items()}
+
+A_PATTERN = re.compile(r'^\s*@([^\s|//*]+)')
+C_PATTERN = re.compile(r'^\s*([MDA+\-=01&!|]*);?([JGELTMPNQ]{0,3})')
+LABEL_PATTERN = re.compile(r'^\s*\((.+)\)')
+
+# instruction records produced in process, as by vm_trans for build.py: an
+# encoded instruction word, the symbol of an A-instruction, or a Label that
+# binds its name to the address of the next instruction
+Label = namedtuple('Label', ['name'])
+
+C_CACHE_SIZE = 1024
+STREAM_CHUNK = 4096
+IHEX_RECORD_SIZE = 16
+
+def chunked(words):
+    words = iter(words)
+    chunk = array('H', itertools.islice(words, STREAM_CHUNK))
+    while chunk:
+        yield chunk
+        chunk = array('H', itertools.islice(words, STREAM_CHUNK))
+
+def littleEndian(chunk):
+    if sys.byteorder != 'little':
+        chunk = array('H', chunk)
+        chunk.byteswap()
+    return chunk.tobytes()
+
+def writeHack(chunks, out):
+    for chunk in chunks:
+        out.write(''.join(map('{:016b}\n'.format, chunk)))
+
+def writeBin(chunks, out):
+    # packed image of little-endian 16-bit words
+    for chunk in chunks:
+        out.write(littleEndian(chunk))
+
+def ihexRecord(address, record_type, data=b''):
+    record = bytes([len(data), address >> 8 & 0xFF, address & 0xFF, record_type]) + data
+    return ':{}{:02X}\n'.format(record.hex().upper(), -sum(record) & 0xFF)
+
+def writeIhex(chunks, out):
+    # Intel HEX with 16-byte data records of the little-endian image, an
+    # extended linear address record every 64K and an end of file record
+    address = 0
+    pending = b''
+    for chunk in chunks:
+        pending += littleEndian(chunk)
+        lines = []
+        start = 0
+        while len(pending) - start >= IHEX_RECORD_SIZE:
+            if address and not address & 0xFFFF:
+                lines.append(ihexRecord(0, 4, (address >> 16).to_bytes(2, 'big')))
+            lines.append(ihexRecord(address & 0xFFFF, 0, pending[start:start + IHEX_RECORD_SIZE]))
+            start += IHEX_RECORD_SIZE
+            address += IHEX_RECORD_SIZE
+        pending = pending[start:]
+        out.write(''.join(lines))
+    if pending:
+        if address and not address & 0xFFFF:
+            out.write(ihexRecord(0, 4, (address >> 16).to_bytes(2, 'big')))
+        out.write(ihexRecord(address & 0xFFFF, 0, pending))
+    out.write(ihexRecord(0, 1))
+
+FORMATS = {
+    'hack': ('hack', 'w',  writeHack),
+    'bin':  ('bin',  'wb', writeBin),
+    'ihex': ('hex',  'w',  writeIhex)
+}
+
+def writeFile(chunks, filename, output_format='hack'):
+    extension, mode, writer = FORMATS[output_format]
+    f = open('{name}.{ext}'.format(name=filename.split('.')[0], ext=extension), mode)
+    writer(chunks, f)
     f.close()
 
 
+def encodeA(operand):
+    # record of the A-instruction @operand: its word, or the symbol
+    if operand.isnumeric():
+        value = int(operand)
+        if value > 0x7FFF:
+            raise ValueError('A constant out of range: @{}'.format(operand))
+        return value
+    return operand
+
 def parseA(line):
-    m = re.match(r'^\s*@([^\s|//*]+)', line)
+    m = A_PATTERN.match(line)
     if m:
-        if m.group(1).isnumeric():
-            return '0{:0=15b}\n'.format(int(m.group(1)))
-        elif m.group(1) in SYMBOL_TABLE:
-            return '0{:0=15b}\n'.format(SYMBOL_TABLE[m.group(1)])
-        else:
-            SYMBOL_TABLE[m.group(1)] = SYMBOL_TABLE['INS_PTR']
-            SYMBOL_TABLE['INS_PTR'] += 1
-            return '0{:0=15b}\n'.format(SYMBOL_TABLE[m.group(1)])
+        return encodeA(m.group(1))
     else:
-        return 'no match for A'
+        raise ValueError('no match for A: {}'.format(line.strip()))
+
+@functools.lru_cache(maxsize=C_CACHE_SIZE)
+def encodeC(instruction):
+    m = C_PATTERN.match(instruction)
+    if not m:
+        raise ValueError('no match for C: {}'.format(instruction))
+    comp = m.group(1)
+    dest = ''
+    if '=' in comp:
+        dest, _, comp = comp.partition('=')
+    jump = m.group(2)
+    if comp not in COMP_CODES or dest not in DEST_CODES or jump not in JUMP_CODES:
+        raise ValueError('no match for C: {}'.format(instruction))
+    return 0xE000 | COMP_CODES[comp] | DEST_CODES[dest] | JUMP_CODES[jump]
 
 def parseC(line):
-    m = re.split(r'^\s*([MDA+\-=01&!|]*);?([JGELTMPNQ]{0,3})', line, maxsplit=3)
-    if m:
-        try:
-            dest, comp = m[1].split('=')
-        except (ValueError):
-            comp = m[1]
-            dest = ''
-        jump = m[-2]
-        return '111{comp}{dest}{jump}\n'.format(comp=COMP_TABLE[comp], dest=DEST_TABLE[dest], jump=JUMP_TABLE[jump])
+    # programs repeat a small set of C-instructions, so encodings are memoized
+    # on the instruction text without indentation and trailing comment
+    return encodeC(line.split('//', 1)[0].strip())
+
+def parseLine(line):
+    if ("@" in line) and (line[:2] != '//'):
+        return parseA(line)
+    elif (";" in line or "=" in line) and (line[:2] != '//'):
+        return parseC(line)
     else:
-        return 'no match for C'
+        return None
+
+def parseRecord(line):
+    # instruction record of one line, None for a line without one
+    record = parseLine(line)
+    if record is None:
+        m = LABEL_PATTERN.match(line)
+        if m:
+            return Label(m.group(1))
+    return record
+
+def formatRecord(record):
+    # assembly text of an instruction record
+    if type(record) is Label:
+        return '({})'.format(record.name)
+    elif type(record) is str or record < 0x8000:
+        return '@{}'.format(record)
+    return '{}{}{}'.format(DEST_NAMES[record & 0x38] + '=' if record & 0x38 else '', COMP_NAMES[record & 0x1FC0],
+                           ';' + JUMP_NAMES[record & 7] if record & 7 else '')
 
-def analyzeSymbols(file):
-    line_count = -1
+def analyzeSymbols(file, symbols):
+    # first pass: parse every line once into a compact record and bind labels
+    # to the address of the next instruction. A record is either the encoded
+    # instruction word or the name of a symbol to be resolved in pass two.
+    program = []
+    for line in file:
+        record = parseLine(line)
+        if record is not None:
+            program.append(record)
+        else:
+            m = LABEL_PATTERN.match(line)
+            if m:
+                symbols[m.group(1)] = len(program)
+    return program
+
+def resolveSymbol(name, symbols):
+    # variables are allocated from INS_PTR on first use
+    if name not in symbols:
+        symbols[name] = symbols['INS_PTR']
+        symbols['INS_PTR'] += 1
+    address = symbols[name]
+    if address > 0x7FFF:
+        raise ValueError('address of {} out of range: {}'.format(name, address))
+    return address
+
+def resolveSymbols(program, symbols):
+    # second pass: resolve symbols and encode the program into 16-bit words
+    words = array('H', bytes(2 * len(program)))
+    for i, record in enumerate(program):
+        if isinstance(record, str):
+            record = resolveSymbol(record, symbols)
+        words[i] = record
+    return words
+
+def bindLabels(file, symbols):
+    # streaming pass one over a file that can be read again: only labels are
+    # bound, instructions are counted but not kept
+    line_count = 0
     for line in file:
         if ("@" in line or ";" in line or "=" in line) and (line[:2] != '//'):
             line_count += 1
         else:
-            m = re.match(r'^\s*\((.+)\)', line)
+            m = LABEL_PATTERN.match(line)
             if m:
-                SYMBOL_TABLE[m.group(1)] = line_count + 1
+                symbols[m.group(1)] = line_count
     file.seek(0)
+    return (record for record in map(parseLine, file) if record is not None)
 
+def spoolLabels(file, symbols, spool):
+    # streaming pass one over stdin or a pipe: bind labels and spool the
+    # records to a temp file as 32-bit codes instead of keeping the text.
+    # Symbols are spooled as 0x10000 + their index in names.
+    names = []
+    name_index = {}
+    chunk = array('I')
+    line_count = 0
+    for line in file:
+        record = parseLine(line)
+        if record is None:
+            m = LABEL_PATTERN.match(line)
+            if m:
+                symbols[m.group(1)] = line_count
+            continue
+        if isinstance(record, str):
+            if record not in name_index:
+                name_index[record] = len(names)
+                names.append(record)
+            record = 0x10000 + name_index[record]
+        chunk.append(record)
+        line_count += 1
+        if len(chunk) == STREAM_CHUNK:
+            chunk.tofile(spool)
+            del chunk[:]
+    chunk.tofile(spool)
+    spool.seek(0)
 
-def parseLine(line):
-    if ("@" in line) and (line[:2] != '//'):
-        return parseA(line)
-    elif (";" in line or "=" in line) and (line[:2] != '//'):
-        return parseC(line)
-    else:
-         return ''
+    def readSpool(remaining):
+        while remaining:
+            chunk = array('I')
+            chunk.fromfile(spool, min(remaining, STREAM_CHUNK))
+            remaining -= len(chunk)
+            for code in chunk:
+                yield code if code < 0x10000 else names[code - 0x10000]
+    return readSpool(line_count)
 
-def parse(file):
-    parsed_data = ''
-    analyzeSymbols(file)
-    for line in file:
-        parsed_data += parseLine(line)
-    writeFile(parsed_data, os.path.split(file.name)[1])
+def streamWords(records, symbols):
+    # streaming pass two: resolve and encode one record at a time
+    for record in records:
+        if isinstance(record, str):
+            record = resolveSymbol(record, symbols)
+        yield record
+
+def assemble(lines):
+    # both passes over any iterable of assembly lines, returns the words
+    symbols = dict(SYMBOL_TABLE)
+    program = analyzeSymbols(lines, symbols)
+    return resolveSymbols(program, symbols)
+
+def assembleRecords(records):
+    # both passes over instruction records, returns the words
+    symbols = dict(SYMBOL_TABLE)
+    program = []
+    for record in records:
+        if type(record) is Label:
+            symbols[record.name] = len(program)
+        else:
+            program.append(record)
+    return resolveSymbols(program, symbols)
+
+def parse(file, output_format='hack'):
+    words = assemble(file)
+    writeFile([words], os.path.split(file.name)[1], output_format)
+
+def parseStream(file, output_format='hack'):
+    # memory stays flat in program size: only the symbol table is kept
+    symbols = dict(SYMBOL_TABLE)
+    if file.seekable():
+        records = bindLabels(file, symbols)
+    else:
+        spool = tempfile.TemporaryFile()
+        records = spoolLabels(file, symbols, spool)
+    chunks = chunked(streamWords(records, symbols))
+    if file is sys.stdin:
+        extension, mode, writer = FORMATS[output_format]
+        writer(chunks, sys.stdout.buffer if 'b' in mode else sys.stdout)
+    else:
+        writeFile(chunks, os.path.split(file.name)[1], output_format)
 
 def main ():
     argparser = argparse.ArgumentParser(description='Produce binary program from HACK assembly program')
     argparser.add_argument('infile', type=argparse.FileType('r', encoding='UTF-8'))
+    argparser.add_argument('--format', choices=FORMATS, default='hack',
+                           help='output format: .hack text, packed little-endian image (.bin) or Intel HEX (.hex)')
+    argparser.add_argument('--cache-stats', action='store_true', help='print C-instruction encoding cache statistics')
+    argparser.add_argument('--stream', action='store_true',
+                           help='stream the output without holding the program in memory (stdin is written to stdout)')
     args = argparser.parse_args()
-    parse(args.infile)
+    if args.stream:
+        parseStream(args.infile, args.format)
+    else:
+        parse(args.infile, args.format)
+    if args.cache_stats:
+        info = encodeC.cache_info()
+        print('C-instruction cache: {} hits, {} misses, {}/{} entries'.format(info.hits, info.misses, info.currsize, info.maxsize),
+              file=sys.stderr)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,131 @@
+import argparse
+import os
+import sys
+import time
+from array import array
+from hack_asm import COMP_TABLE
+
+# ALU of the Hack CPU by comp mnemonic. Results are wrapped to signed 16-bit
+# values so they can be stored in the array('h') RAM.
+ALU_TABLE = {
+    '0':   lambda d, a, m: 0,
+    '1':   lambda d, a, m: 1,
+    '-1':  lambda d, a, m: -1,
+    'D':   lambda d, a, m: d,
+    'A':   lambda d, a, m: a,
+    '!D':  lambda d, a, m: ~d,
+    '!A':  lambda d, a, m: ~a,
+    '-D':  lambda d, a, m: ((0x8000 - d) & 0xFFFF) - 0x8000,
+    '-A':  lambda d, a, m: ((0x8000 - a) & 0xFFFF) - 0x8000,
+    'D+1': lambda d, a, m: ((d + 0x8001) & 0xFFFF) - 0x8000,
+    'A+1': lambda d, a, m: ((a + 0x8001) & 0xFFFF) - 0x8000,
+    'D-1': lambda d, a, m: ((d + 0x7FFF) & 0xFFFF) - 0x8000,
+    'A-1': lambda d, a, m: ((a + 0x7FFF) & 0xFFFF) - 0x8000,
+    'D+A': lambda d, a, m: ((d + a + 0x8000) & 0xFFFF) - 0x8000,
+    'D-A': lambda d, a, m: ((d - a + 0x8000) & 0xFFFF) - 0x8000,
+    'A-D': lambda d, a, m: ((a - d + 0x8000) & 0xFFFF) - 0x8000,
+    'D&A': lambda d, a, m: d & a,
+    'D|A': lambda d, a, m: d | a,
+    'M':   lambda d, a, m: m,
+    '!M':  lambda d, a, m: ~m,
+    '-M':  lambda d, a, m: ((0x8000 - m) & 0xFFFF) - 0x8000,
+    'M+1': lambda d, a, m: ((m + 0x8001) & 0xFFFF) - 0x8000,
+    'M-1': lambda d, a, m: ((m + 0x7FFF) & 0xFFFF) - 0x8000,
+    'D+M': lambda d, a, m: ((d + m + 0x8000) & 0xFFFF) - 0x8000,
+    'D-M': lambda d, a, m: ((d - m + 0x8000) & 0xFFFF) - 0x8000,
+    'M-D': lambda d, a, m: ((m - d + 0x8000) & 0xFFFF) - 0x8000,
+    'D&M': lambda d, a, m: d & m,
+    'D|M': lambda d, a, m: d | m
+}
+
+# comp field of a C-instruction -> ALU function
+ALU_CODES = {int(bits, 2): ALU_TABLE[comp] for comp, bits in COMP_TABLE.items()}
+# jump field -> whether the jump is taken for a negative, zero and positive
+# result
+JUMP_MASKS = [None] + [(bool(jump & 4), bool(jump & 2), bool(jump & 1)) for jump in range(1, 8)]
+
+RAM_SIZE = 0x8000
+MAX_CYCLES = 10000000
+
+def loadProgram(path):
+    # .hack text or the packed little-endian image written by --format bin
+    words = array('H')
+    if os.path.splitext(path)[1] == '.bin':
+        with open(path, 'rb') as f:
+            words.frombytes(f.read())
+        if sys.byteorder != 'little':
+            words.byteswap()
+    else:
+        with open(path) as f:
+            words.extend(int(line, 2) for line in f if line.strip())
+    return words
+
+def decodeProgram(words):
+    # every word is decoded once into a dispatch entry (alu, dest, jump):
+    # (None, value, halt) for an A-instruction, where halt marks the
+    # @n / 0;JMP loop at address n that ends a Hack program, and
+    # (ALU function, dest mask, jump mask) for a C-instruction
+    program = []
+    for address, word in enumerate(words):
+        if word < 0x8000:
+            halt = (word == address and address + 1 < len(words) and words[address + 1] >= 0x8000
+                    and words[address + 1] & 0x3F == 7)
+            program.append((None, word, halt))
+        else:
+            program.append((ALU_CODES[(word >> 6) & 0x7F], (word >> 3) & 7, JUMP_MASKS[word & 7]))
+    return program
+
+def run(program, max_cycles=MAX_CYCLES, ram=None):
+    # returns the RAM, the number of cycles run and whether the program
+    # reached its halt loop
+    if ram is None:
+        ram = array('h', bytes(2 * RAM_SIZE))
+    a = d = pc = 0
+    cycles = 0
+    size = len(program)
+    while cycles < max_cycles and pc < size:
+        alu, dest, jump = program[pc]
+        if alu is None:
+            if jump:
+                return ram, cycles, True
+            a = dest
+            pc += 1
+            cycles += 1
+            continue
+        cycles += 1
+        r = alu(d, a, ram[a & 0x7FFF])
+        if jump is not None and jump[0 if r < 0 else (1 if r == 0 else 2)]:
+            pc = a & 0x7FFF
+        else:
+            pc += 1
+        if dest:
+            if dest & 1:
+                ram[a & 0x7FFF] = r
+            if dest & 2:
+                d = r
+            if dest & 4:
+                a = r
+    return ram, cycles, False
+
+def parseRange(text):
+    start, _, end = text.partition(':')
+    return int(start), int(end or start) + (0 if end else 1)
+
+def main ():
+    argparser = argparse.ArgumentParser(description='Run a HACK binary program')
+    argparser.add_argument('infile', help='.hack program, or a .bin image from hack_asm.py --format bin')
+    argparser.add_argument('--max-cycles', type=int, default=MAX_CYCLES, help='stop after this many cycles')
+    argparser.add_argument('--dump', type=parseRange, action='append', default=[], metavar='START:END',
+                           help='print RAM[START:END] after the run, may be repeated')
+    args = argparser.parse_args()
+    program = decodeProgram(loadProgram(args.infile))
+    start = time.perf_counter()
+    ram, cycles, halted = run(program, args.max_cycles)
+    elapsed = time.perf_counter() - start
+    print('{} after {} cycles in {:.2f} s ({:.2f}M cycles/s)'.format(
+        'Halted' if halted else 'Stopped', cycles, elapsed, cycles / elapsed / 1e6 if elapsed else 0))
+    for start, end in args.dump:
+        print('RAM[{}:{}] = {}'.format(start, end, ' '.join(map(str, ram[start:end]))))
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,25 @@
 import argparse
-import re
 import os
 from pathlib import Path
 import xml.etree.ElementTree as ET
+# the tokenizer is shared with compiler.py and also fills the .tokens cache
+from token_cache import cachedTokens, tokenize
 
 FILE = {
     "dir": "",
     "name": ""
 }
 
-KEYWORDS = ['boolean',
-            'char',
-            'class',
-            'constructor',
-            'do',
-            'else',
-            'false',
-            'field',
-            'function',
-            'if',
-            'int',
-            'let',
-            'method',
-            'null',
-            'return',
-            'static',
-            'this',
-            'true',
-            'var',
-            'void',
-            'while']
-
-SYMBOLS = ['{',
-           '}',
-           '(',
-           ')',
-           '[',
-           ']',
-           '.',
-           ',',
-           ';',
-           '+',
-           '-',
-           '*',
-           '/',
-           '&',
-           '|',
-           '<',
-           '>',
-           '=',
-           '~']
-
-TOKEN_SEPARATOR = SYMBOLS + [' ', '\r']
-
-PATTERNS = (
-    ('|'.join(['^{}$'.format(x) for x in KEYWORDS]), 'keyword',0),
-    ('|^\\'.join(SYMBOLS), 'symbol',0),
-    ('^([0-9]*$)',  'integerConstant',1),
-    ('^\"(.*)\"', 'stringConstant',1),
-    ('^([a-zA-Z_][a-zA-Z_0-9]*$)', 'identifier',1)
-)
 
 class tokenIterator:
-    def __init__(self, input_file):
-        self.input_file = input_file
+    # the parser reads the (type, text) records of a file, from
+    # token_cache.tokenize or from the token cache
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
         self.processed = True
         self.token = ''
 
     def __iter__(self):
-        self.token = ''
         return self
 
     def getStatus(self):
@@ -81,77 +32,9 @@ class tokenIterator:
         return self.token
 
     def __next__(self):
-        self.token=''
-        char = self.input_file.read(1).decode('utf-8')
-        # print(self.input_file.tell(), ord(char), char)
-        if char in SYMBOLS:
-            if char == '/':
-                next_char = self.input_file.read(1).decode('utf-8')
-                if next_char == '/':
-                    self.input_file.readline()
-                    return next(self)
-                elif next_char == '*':
-                    blockcomment_end1 = self.input_file.read(1).decode('utf-8')
-                    blockcomment_end2 = self.input_file.read(1).decode('utf-8')
-                    while not(blockcomment_end1 == '*' and blockcomment_end2 == '/') and not(blockcomment_end1 == '' or blockcomment_end2 == ''):
-                        blockcomment_end1 = self.input_file.read(1).decode('utf-8')
-                        if blockcomment_end1 == '*':
-                            blockcomment_end2 = self.input_file.read(1).decode('utf-8')
-                    return next(self)
-                else:
-                    # print("not a comment")
-                    self.input_file.seek(self.input_file.tell() - 1, 0)   # move read cursor one char back
-                    self.token = parseToken(char)
-                    self.processed = False
-                    return self.token
-            else:
-                self.token = parseToken(char)
-                self.processed = False
-                return self.token
-        elif char == '"':
-            self.token = char
-            next_char = self.input_file.read(1).decode('utf-8')
-            while (next_char != '"'):
-                self.token += next_char
-                next_char = self.input_file.read(1).decode('utf-8')
-            else:
-                self.token += next_char
-            self.token = parseToken(self.token)
-            self.processed = False
-            return self.token
-        elif (char.isalnum() or char == '_'):
-            while ((char != '') and not(char in TOKEN_SEPARATOR)):
-                self.token += char
-                char = self.input_file.read(1).decode('utf-8')
-            # print('current char ', char)
-            # print('current pos ', self.input_file.tell())
-            self.input_file.seek(self.input_file.tell() - 1, 0)
-            self.token = parseToken(self.token)
-            self.processed = False
-            return self.token
-        elif char == '':
-            raise StopIteration
-        else:
-            return next(self)
-
-
-def parseToken(word):
-    rules = [ matchApplyBuilder(pattern, token_type, match_group) for (pattern, token_type, match_group) in PATTERNS ]
-    token_matched = False
-    for matchRule, applyRule in rules:
-        if matchRule(word) and not(token_matched):
-            token_matched = True
-            return applyRule(word)
-    return None
-
-def matchApplyBuilder(pattern, token_type, match_group):
-    def matchRule(word):
-        return re.search(pattern, word)
-    def applyRule(word):
-        match = re.search(pattern, word)
-        if match:
-            return (token_type, match.group(match_group))
-    return (matchRule, applyRule)
+        self.token = next(self.tokens)
+        self.processed = False
+        return self.token
 
 
 def compile(tokenizer):
@@ -759,17 +642,20 @@ def writeFile(data, filename):
 
 
 
-def parse(path):
+def parse(path, token_cache=False):
     p = Path(path)
     FILE['name'] = p.stem
     print('Opening single file %s' % FILE['name'])
     parsed_data = ''
-    with open(p, mode='rb') as f:
-        tokenizer = tokenIterator(f)
-        parsed_data = compile(tokenizer)
+    if token_cache:
+        tokens = cachedTokens(p, tokenize)
+    else:
+        with open(p, mode='rb') as f:
+            tokens = tokenize(f.read())
+    parsed_data = compile(tokenIterator(tokens))
     writeFile(parsed_data, FILE['name'])
 
-def parsedir(path):
+def parsedir(path, token_cache=False):
     p = Path(path)
     FILE['dir'] = p.name
     parsed_data = ''
@@ -777,19 +663,24 @@ def parsedir(path):
     for fl in p.glob('*.jack'):
         FILE['name'] = fl.stem
         print('Opening dir file %s' % FILE['name'])
-        with open(fl, mode='rb') as f:
-            tokenizer = tokenIterator(f)
-            parsed_data = compile(tokenizer)
+        if token_cache:
+            tokens = cachedTokens(fl, tokenize)
+        else:
+            with open(fl, mode='rb') as f:
+                tokens = tokenize(f.read())
+        parsed_data = compile(tokenIterator(tokens))
         writeFile(parsed_data, FILE['name'])    
 
 def main ():
     argparser = argparse.ArgumentParser(description='Produce xml from JACK program')
     argparser.add_argument('input')
+    argparser.add_argument('--token-cache', action='store_true',
+                           help='read tokens from the .tokens cache next to each source file, shared with compiler.py')
     args = argparser.parse_args()
     if os.path.isfile(args.input):
-        parse(args.input)
+        parse(args.input, args.token_cache)
     elif os.path.isdir(args.input):
-        parsedir(args.input)
+        parsedir(args.input, args.token_cache)
     else:
         print('Path error')
         return None
@@ -0,0 +1,178 @@
+import hashlib
+import mmap
+import re
+import struct
+from array import array
+from pathlib import Path
+
+# token cache kept next to each .jack file: a header, the token type codes
+# as array('B'), the index of each token text in the string table as
+# array('I'), the byte lengths of the strings as array('I') and the utf-8
+# strings themselves
+CACHE_SUFFIX = '.tokens'
+# a cache with another magic was written in an older layout or by another
+# tokenizer and counts as a miss
+CACHE_MAGIC = b'JTK2'
+CACHE_HEADER = struct.Struct('<4s20sII')    # magic, sha1 of the source, token count, string count
+
+TOKEN_TYPES = ('keyword', 'symbol', 'integerConstant', 'stringConstant', 'identifier')
+TYPE_CODES = {token_type: code for code, token_type in enumerate(TOKEN_TYPES)}
+
+# the Jack tokenizer shared by compiler.py and syntax_anl.py
+KEYWORDS = ['boolean',
+            'char',
+            'class',
+            'constructor',
+            'do',
+            'else',
+            'false',
+            'field',
+            'function',
+            'if',
+            'int',
+            'let',
+            'method',
+            'null',
+            'return',
+            'static',
+            'this',
+            'true',
+            'var',
+            'void',
+            'while']
+
+SYMBOLS = ['{',
+           '}',
+           '(',
+           ')',
+           '[',
+           ']',
+           '.',
+           ',',
+           ';',
+           '+',
+           '-',
+           '*',
+           '/',
+           '&',
+           '|',
+           '<',
+           '>',
+           '=',
+           '~']
+
+TOKEN_SEPARATOR = SYMBOLS + [' ', '\r']
+
+KEYWORD_SET = frozenset(KEYWORDS)
+SYMBOL_SET = frozenset(SYMBOLS)
+
+CONST_PATTERNS = (
+    (re.compile(r'([0-9]*)$'), 'integerConstant'),
+    (re.compile(r'"(.*)"'), 'stringConstant'),
+    (re.compile(r'([a-zA-Z_][a-zA-Z_0-9]*)$'), 'identifier')
+)
+
+# character classes of the symbols and of the separators that end a word
+SYMBOL_CLASS = ''.join(map(re.escape, SYMBOLS))
+SEPARATOR_CLASS = ''.join(map(re.escape, TOKEN_SEPARATOR))
+
+TOKEN_SCANNER = re.compile(r'''
+    //[^\n]*\n?                       # line comment
+  | /\*.*?(?:\*/|\Z)                 # block comment
+  | (?P<token>
+        [a-zA-Z0-9_][^{separators}]*    # word, up to TOKEN_SEPARATOR
+      | "[^"]*"?                      # string constant
+      | [{symbols}]                   # symbol
+    )
+  | [^a-zA-Z0-9_"{symbols}]+          # whitespace and anything else
+'''.format(separators=SEPARATOR_CLASS, symbols=SYMBOL_CLASS), re.DOTALL | re.VERBOSE)
+
+def scanTokens(text):
+    # token texts of a source file, comments and whitespace skipped
+    for m in TOKEN_SCANNER.finditer(text):
+        if m.lastgroup == 'token':
+            yield m.group('token')
+
+def tokenize(source):
+    # the file is tokenized once into a list of records; equal tokens share
+    # one record
+    records = {}
+    return [records.setdefault(token, token)
+            for token in map(parseToken, scanTokens(source.decode('utf-8')))]
+
+def parseToken(word):
+    # a word token may still carry the newline that ended it
+    key = word[:-1] if word[-1:] == '\n' else word
+    if key in KEYWORD_SET:
+        return ('keyword', key)
+    if word in SYMBOL_SET:
+        return ('symbol', word)
+    for pattern, token_type in CONST_PATTERNS:
+        match = pattern.match(word)
+        if match:
+            return (token_type, match.group(1))
+    return None
+
+def cachePath(source):
+    return Path(source).with_suffix(CACHE_SUFFIX)
+
+def saveTokens(source, digest, tokens):
+    strings = {}
+    codes = array('B', [TYPE_CODES[token_type] for token_type, token_text in tokens])
+    index = array('I', [strings.setdefault(token_text, len(strings)) for token_type, token_text in tokens])
+    data = [text.encode('utf-8') for text in strings]
+    lengths = array('I', map(len, data))
+    with open(cachePath(source), 'wb') as f:
+        f.write(CACHE_HEADER.pack(CACHE_MAGIC, digest, len(codes), len(data)))
+        f.write(codes.tobytes())
+        f.write(index.tobytes())
+        f.write(lengths.tobytes())
+        f.write(b''.join(data))
+
+def loadTokens(source, digest):
+    # returns None when there is no cache, it was written for other contents
+    # or it is damaged
+    try:
+        with open(cachePath(source), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            magic, cached_digest, count, string_count = CACHE_HEADER.unpack_from(m)
+            if magic != CACHE_MAGIC or cached_digest != digest:
+                return None
+            pos = CACHE_HEADER.size
+            codes = array('B', m[pos:pos + count])
+            pos += count
+            index = array('I')
+            index.frombytes(m[pos:pos + index.itemsize * count])
+            pos += index.itemsize * count
+            lengths = array('I')
+            lengths.frombytes(m[pos:pos + lengths.itemsize * string_count])
+            pos += lengths.itemsize * string_count
+            if len(lengths) != string_count or pos + sum(lengths) != len(m):
+                return None
+            # a damaged type code or string index also makes the cache unusable
+            if count and (max(codes) >= len(TOKEN_TYPES) or max(index) >= string_count):
+                return None
+            strings = []
+            for length in lengths:
+                strings.append(m[pos:pos + length].decode('utf-8'))
+                pos += length
+    except (OSError, ValueError, struct.error):
+        return None
+    # equal tokens share one record, as in a freshly scanned file
+    records = {}
+    tokens = []
+    for code, i in zip(codes, index):
+        token = (TOKEN_TYPES[code], strings[i])
+        tokens.append(records.setdefault(token, token))
+    return tokens
+
+def cachedTokens(path, tokenize):
+    # tokens of a source file, read from its cache while the source is
+    # unchanged, else produced by tokenize(source bytes) and cached
+    source = Path(path).read_bytes()
+    digest = hashlib.sha1(source).digest()
+    tokens = loadTokens(path, digest)
+    if tokens is None:
+        tokens = tokenize(source)
+        if None not in tokens:
+            saveTokens(path, digest, tokens)
+    return tokens
@@ -0,0 +1,101 @@
+import enum
+import functools
+from collections import namedtuple
+
+COMMAND_CACHE_SIZE = 4096
+
+# VM IR: one VmCommand record per command, with op an Op, segment a Segment
+# for push and pop, index the int operand (segment index, nVars or nArgs)
+# and name the label or function name
+class Op(enum.IntEnum):
+    PUSH = 0
+    POP = 1
+    ADD = 2
+    SUB = 3
+    NEG = 4
+    EQ = 5
+    GT = 6
+    LT = 7
+    AND = 8
+    OR = 9
+    NOT = 10
+    LABEL = 11
+    GOTO = 12
+    IF_GOTO = 13
+    FUNCTION = 14
+    CALL = 15
+    RETURN = 16
+
+class Segment(enum.IntEnum):
+    CONSTANT = 0
+    LOCAL = 1
+    ARGUMENT = 2
+    THIS = 3
+    THAT = 4
+    TEMP = 5
+    POINTER = 6
+    STATIC = 7
+
+# plain names for the members, enum attribute lookups are slow in the
+# translation loops
+PUSH, POP, ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT, LABEL, GOTO, IF_GOTO, FUNCTION, CALL, RETURN = Op
+CONSTANT, LOCAL, ARGUMENT, THIS, THAT, TEMP, POINTER, STATIC = Segment
+
+VmCommand = namedtuple('VmCommand', ['op', 'segment', 'index', 'name'], defaults=[None, 0, None])
+
+OP_NAMES = {op: op.name.lower().replace('_', '-') for op in Op}
+SEGMENT_NAMES = {segment: segment.name.lower() for segment in Segment}
+SEGMENT_CODES = {name: segment for segment, name in SEGMENT_NAMES.items()}
+# commands without operands are shared records
+SIMPLE_COMMANDS = {OP_NAMES[op]: VmCommand(op) for op in (ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT, RETURN)}
+LABEL_OPS = {OP_NAMES[op]: op for op in (LABEL, GOTO, IF_GOTO)}
+FRAME_OPS = {OP_NAMES[op]: op for op in (FUNCTION, CALL)}
+STACK_OPS = {OP_NAMES[op]: op for op in (PUSH, POP)}
+FRAME_CODES = frozenset(FRAME_OPS.values())
+
+def parseVm(lines):
+    # one pass over VM text into VmCommand records; comments and blank lines
+    # are dropped. Records are immutable, so a repeated line shares the
+    # record parsed for its first occurrence.
+    commands = []
+    append = commands.append
+    records = {}
+    for number, line in enumerate(lines, 1):
+        record = records.get(line)
+        if record is None:
+            record = records[line] = parseCommand(line, number)
+        if record:
+            append(record)
+    return commands
+
+def parseCommand(line, number=0):
+    # VmCommand record of one line, () for a line without a command
+    words = line.split('//', 1)[0].split()
+    if not words:
+        return ()
+    word = words[0]
+    try:
+        if word in SIMPLE_COMMANDS:
+            return SIMPLE_COMMANDS[word]
+        elif word in STACK_OPS:
+            return VmCommand(STACK_OPS[word], SEGMENT_CODES[words[1]], int(words[2]))
+        elif word in LABEL_OPS:
+            return VmCommand(LABEL_OPS[word], None, 0, words[1])
+        return VmCommand(FRAME_OPS[word], None, int(words[2]), words[1])
+    except (KeyError, IndexError, ValueError):
+        raise ValueError('line {}: not a VM command: {}'.format(number, line.strip()))
+
+@functools.lru_cache(maxsize=COMMAND_CACHE_SIZE)
+def formatCommand(command):
+    if command.segment is not None:
+        return '{} {} {}'.format(OP_NAMES[command.op], SEGMENT_NAMES[command.segment], command.index)
+    elif command.op in FRAME_CODES:
+        return '{} {} {}'.format(OP_NAMES[command.op], command.name, command.index)
+    elif command.name is not None:
+        return '{} {}'.format(OP_NAMES[command.op], command.name)
+    return OP_NAMES[command.op]
+
+def formatVm(commands):
+    # VmCommand records back to VM text
+    text = '\n'.join(map(formatCommand, commands))
+    return text + '\n' if text else ''
@@ -1,7 +1,14 @@
 import argparse
-import re
+import contextlib
+import functools
 import os
+import string
+from collections import namedtuple
 from pathlib import Path
+from hack_asm import Label, encodeA, encodeC, parseRecord
+from vm_ir import (VmCommand, PUSH, POP, ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT, LABEL, GOTO, IF_GOTO,
+                   FUNCTION, CALL, RETURN, CONSTANT, TEMP, POINTER, STATIC, OP_NAMES, SEGMENT_CODES,
+                   parseVm, formatCommand)
 
 BOOT = {
     "code": "@256\nD=A\n@SP\nM=D\n"
@@ -34,7 +41,7 @@ FLOW_TABLE = {
 }
 
 FUNC_TABLE = {
-    "function": "({caller})\n{push0n}",
+    "function": "({caller})\n",
     "call":  '''//push retAddrLabel
                 @{caller}$ret.{i}\nD=A\n@SP\nA=M\nM=D\n@SP\nM=M+1
                 //push LCL
@@ -73,7 +80,8 @@ FUNC_TABLE = {
                     @{caller}$ret.{i}\nA=M\n0;JMP\n''',
     "caller": "",
     "calee": "",
-    "calee_count": 0
+    "calee_count": 0,
+    "ret_count": 0
 }
 
 FILE = {
@@ -81,134 +89,650 @@ FILE = {
     "name": ""
 }
 
-def writeFile(data, filename):
-    f = open('{name}.asm'.format(name=filename), 'w')
-    f.write(data)
-    f.close()
-
-def pushPop(args):
-    #print('start parsing push/pop')
-    #print(args)
-    if args[:-1] == ['push', 'constant']:
-        res = '@{value}\nD=A\n@SP\nA=M\nM=D\n@SP\nM=M+1\n'.format(value=args[2])
-    elif args[0] == 'push' and args[1] in SEG_PTRS:
-        res = '@{segment}\nD=M\n@{value}\nD=D+A\nA=D\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n'.format(segment=SEG_PTRS[args[1]], value=args[2])
-    elif  args[0] == 'pop' and args[1] in SEG_PTRS:
-        res = '@{segment}\nD=M\n@{value}\nD=D+A\n@SP\nA=M\nM=D\nA=A-1\nD=M\nA=A+1\nA=M\nM=D\n@SP\nM=M-1\n'.format(segment=SEG_PTRS[args[1]], value=args[2])
-    elif args[0] == 'push' and args[1] == 'temp':
-        res = '@5\nD=A\n@{value}\nD=D+A\nA=D\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n'.format(value=args[2])
-    elif  args[0] == 'pop' and args[1] == 'temp':
-        res = '@5\nD=A\n@{value}\nD=D+A\n@SP\nA=M\nM=D\nA=A-1\nD=M\nA=A+1\nA=M\nM=D\n@SP\nM=M-1\n'.format(value=args[2])
-    elif args[0] == 'push' and args[1] == 'static':
-        res = '@{varname}.{value}\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n'.format(varname=FILE['name'], value=args[2])
-    elif args[0] == 'pop' and args[1] == 'static':
-        res = '@SP\nM=M-1\nA=M\nD=M\n@{varname}.{value}\nM=D\n'.format(varname=FILE['name'], value=args[2])
-    elif args[0] == 'push' and args[1] == 'pointer':
-        res = '@{ptr}\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n'.format(ptr='THIS' if args[2]=='0' else 'THAT')
-    elif args[0] == 'pop' and args[1] == 'pointer':
-        res = '@SP\nM=M-1\nA=M\nD=M\n@{ptr}\nM=D\n'.format(ptr='THIS' if args[2]=='0' else 'THAT')
+# set by startTranslation, for build.py the translation yields hack_asm
+# instruction records instead of text, see code()
+OUTPUT = {
+    "records": False
+}
+
+# segments addressed through a base pointer
+BASE_POINTERS = {SEGMENT_CODES[name]: pointer for name, pointer in SEG_PTRS.items() if name in SEGMENT_CODES}
+
+PUSH_0 = '@SP\nA=M\nM=0\n@SP\nM=M+1\n'
+
+# -O lowering: the top of the stack is kept in D between commands
+POP_D = '@SP\nAM=M-1\nD=M\n'
+PUSH_D = '@SP\nM=M+1\nA=M-1\nM=D\n'
+ALU_M = {ADD: 'D=D+M', SUB: 'D=M-D', AND: 'D=D&M', OR: 'D=D|M'}
+ALU_A = {ADD: 'D=D+A', SUB: 'D=D-A', AND: 'D=D&A', OR: 'D=D|A'}
+CMP_JUMPS = {EQ: 'JEQ', GT: 'JGT', LT: 'JLT'}
+NOT_JUMPS = {'JEQ': 'JNE', 'JGT': 'JLE', 'JLT': 'JGE'}
+MAX_INC_OFFSET = 8
+# D = -1 if D satisfies {jump}, else 0
+COMPARE_RESULT = '@TRUE.{num}\nD;{jump}\nD=0\n@END.{num}\n0;JMP\n(TRUE.{num})\nD=-1\n(END.{num})\n'
+# call with the stack top flushed; the caller's return address is pushed first
+CALL_D = ('@{ret}\nD=A\n@SP\nA=M\nM=D\n'
+          '@LCL\nD=M\n@SP\nAM=M+1\nM=D\n'
+          '@ARG\nD=M\n@SP\nAM=M+1\nM=D\n'
+          '@THIS\nD=M\n@SP\nAM=M+1\nM=D\n'
+          '@THAT\nD=M\n@SP\nAM=M+1\nM=D\n'
+          '@SP\nMD=M+1\n@LCL\nM=D\n@{frame}\nD=D-A\n@ARG\nM=D\n'
+          '@{name}\n0;JMP\n({ret})\n')
+# return with the return value in D, which is kept in R13 while the frame
+# pointer and the return address are held in R14 and R15
+RETURN_D = ('@R13\nM=D\n@LCL\nD=M\n@R14\nM=D\n@5\nA=D-A\nD=M\n@R15\nM=D\n'
+            '@R13\nD=M\n@ARG\nA=M\nM=D\nD=A+1\n@SP\nM=D\n'
+            '@R14\nAM=M-1\nD=M\n@THAT\nM=D\n'
+            '@R14\nAM=M-1\nD=M\n@THIS\nM=D\n'
+            '@R14\nAM=M-1\nD=M\n@ARG\nM=D\n'
+            '@R14\nAM=M-1\nD=M\n@LCL\nM=D\n'
+            '@R15\nA=M\n0;JMP\n')
+
+# --size: call, return and the compares are emitted once as shared routines.
+# A call site passes the function address in R13, 5 + nArgs in R14 and its
+# return address in D; a compare site leaves x and y on the stack and passes
+# its return address in D.
+SHARED_CALL = ('(VM$CALL)\n@SP\nA=M\nM=D\n'
+               '@LCL\nD=M\n@SP\nAM=M+1\nM=D\n'
+               '@ARG\nD=M\n@SP\nAM=M+1\nM=D\n'
+               '@THIS\nD=M\n@SP\nAM=M+1\nM=D\n'
+               '@THAT\nD=M\n@SP\nAM=M+1\nM=D\n'
+               '@SP\nMD=M+1\n@LCL\nM=D\n@R14\nD=D-M\n@ARG\nM=D\n'
+               '@R13\nA=M\n0;JMP\n')
+SHARED_RETURN = '(VM$RETURN)\n' + RETURN_D
+SHARED_CALL_SITE = '@{name}\nD=A\n@R13\nM=D\n@{frame}\nD=A\n@R14\nM=D\n@{ret}\nD=A\n@VM$CALL\n0;JMP\n({ret})\n'
+SHARED_COMPARE_SITE = '@{ret}\nD=A\n@VM${op}\n0;JMP\n({ret})\n'
+SHARED_COMPARE = ('(VM${op})\n@R14\nM=D\n@SP\nAM=M-1\nD=M\n@SP\nAM=M-1\nD=M-D\n@VM${op}.TRUE\nD;{jump}\n'
+                  'D=0\n@R14\nA=M\n0;JMP\n(VM${op}.TRUE)\nD=-1\n@R14\nA=M\n0;JMP\n')
+# instructions run on the false path of an inline and of a shared compare
+# with both operands on the stack, the call site excluded
+COMPARE_CYCLES = {'inline': 11, 'shared': 14}
+SHARED_USES = {'call': 0, 'return': 0, 'compare': 0, 'rom': 0}
+# shared compare sites by compare op, only the routines used are emitted
+COMPARE_USES = {op: 0 for op in CMP_JUMPS}
+
+OUTPUT_BUFFER = 1 << 20
+ROM_SIZE = 32768
+# --stats: [uses, instructions] per VM command kind, instructions per function
+STATS = {'commands': {}, 'functions': {}}
+STATS_TOP = 20
+
+# a template line with {fields}, made into a record when the template is used
+TemplateLine = namedtuple('TemplateLine', ['kind', 'text'])
+
+def writeFile(chunks, filename):
+    # chunks are written as they are generated through a large buffer, so
+    # the whole program is never held in memory. They go to a temporary file
+    # that replaces the .asm file once the translation is done, so a bad
+    # command does not leave a truncated .asm file behind.
+    name = '{name}.asm'.format(name=filename)
+    temp = name + '.tmp'
+    try:
+        with open(temp, 'w', buffering=OUTPUT_BUFFER) as f:
+            f.writelines(chunks)
+    except BaseException:
+        # open() may have failed before the temporary file was created
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp)
+        raise
+    os.replace(temp, name)
+
+@functools.lru_cache(maxsize=None)
+def compileTemplate(template):
+    # the instruction records of an assembly template, parsed once. Lines
+    # with fields stay TemplateLines; auto-numbered fields are numbered over
+    # the whole template first, so each line can be filled on its own.
+    parts = []
+    number = 0
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        parts.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is not None:
+            if field == '':
+                field = str(number)
+                number += 1
+            parts.append('{' + field + ('!' + conversion if conversion else '') + (':' + spec if spec else '') + '}')
+    records = []
+    for line in ''.join(parts).split('\n'):
+        line = line.strip()
+        if not line or line[:2] == '//':
+            continue
+        if '{' in line:
+            records.append(TemplateLine(line[0] if line[0] in '@(' else 'C', line))
+        else:
+            record = parseRecord(line)
+            if record is not None:
+                records.append(record)
+    return tuple(records)
+
+def fillTemplate(records, args, fields):
+    if TemplateLine not in map(type, records):
+        return records
+    out = []
+    for record in records:
+        if type(record) is TemplateLine:
+            text = record.text.format(*args, **fields)
+            if record.kind == '@':
+                record = encodeA(text[1:])
+            elif record.kind == '(':
+                record = Label(text[1:-1])
+            else:
+                record = encodeC(text)
+        out.append(record)
+    return tuple(out)
+
+def code(template, *args, **fields):
+    # assembly from a template: text, or while OUTPUT['records'] is set a
+    # tuple of instruction records, filled from the template parsed once
+    if OUTPUT['records']:
+        return fillTemplate(compileTemplate(template), args, fields)
+    return template.format(*args, **fields) if args or fields else template
+
+def comment(text):
+    return () if OUTPUT['records'] else '//{}\n'.format(text)
+
+def pushPop(command):
+    segment, index = command.segment, command.index
+    if command.op == PUSH and segment == CONSTANT:
+        res = code('@{value}\nD=A\n@SP\nA=M\nM=D\n@SP\nM=M+1\n', value=index)
+    elif command.op == PUSH and segment in BASE_POINTERS:
+        res = code('@{segment}\nD=M\n@{value}\nD=D+A\nA=D\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n', segment=BASE_POINTERS[segment], value=index)
+    elif command.op == POP and segment in BASE_POINTERS:
+        res = code('@{segment}\nD=M\n@{value}\nD=D+A\n@SP\nA=M\nM=D\nA=A-1\nD=M\nA=A+1\nA=M\nM=D\n@SP\nM=M-1\n', segment=BASE_POINTERS[segment], value=index)
+    elif command.op == PUSH and segment == TEMP:
+        res = code('@5\nD=A\n@{value}\nD=D+A\nA=D\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n', value=index)
+    elif command.op == POP and segment == TEMP:
+        res = code('@5\nD=A\n@{value}\nD=D+A\n@SP\nA=M\nM=D\nA=A-1\nD=M\nA=A+1\nA=M\nM=D\n@SP\nM=M-1\n', value=index)
+    elif command.op == PUSH and segment == STATIC:
+        res = code('@{varname}.{value}\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n', varname=FILE['name'], value=index)
+    elif command.op == POP and segment == STATIC:
+        res = code('@SP\nM=M-1\nA=M\nD=M\n@{varname}.{value}\nM=D\n', varname=FILE['name'], value=index)
+    elif command.op == PUSH and segment == POINTER:
+        res = code('@{ptr}\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n', ptr='THIS' if index == 0 else 'THAT')
+    elif command.op == POP and segment == POINTER:
+        res = code('@SP\nM=M-1\nA=M\nD=M\n@{ptr}\nM=D\n', ptr='THIS' if index == 0 else 'THAT')
+    elif OUTPUT['records']:
+        # the text would be dropped from the instruction records unseen
+        raise ValueError('not a VM command: {}'.format(formatCommand(command)))
     else:
-        res = 'cannot parse the command'
-    res = '//{command}\n'.format(command=' '.join(args)) + res
+        res = code('cannot parse the command')
+    res = comment(formatCommand(command)) + res
     return res
 
 
-def parseCommand(line):
-    res = ''
-    m = re.match(r'^\s*([^//*]+)', line)
-    if m:
-        command = m.group(1).rstrip().split()
-        if command[0] in TR_TABLE:
-            if command[0] in ['eq', 'gt', 'lt']:
-                res = '//{com}\n'.format(com=command[0]) + TR_TABLE[command[0]].format(num=SEG_PTRS['LABEL_COUNT'])
-                SEG_PTRS['LABEL_COUNT'] += 1
-                return res
-            else:
-                return '//{com}\n'.format(com=command[0]) + TR_TABLE[command[0]]
-        elif command[0] in FLOW_TABLE:
-            res = '//{com}\n'.format(com=command[0]) + FLOW_TABLE[command[0]].format(filename=FILE['name'],
-                                                                                     funcName=FUNC_TABLE['caller'],
-                                                                                     label=command[1])
+def emitCommand(command):
+    # plain translation of one VmCommand record
+    op = command.op
+    name = OP_NAMES[op]
+    if name in TR_TABLE:
+        if op in CMP_JUMPS:
+            res = comment(name) + code(TR_TABLE[name], num=SEG_PTRS['LABEL_COUNT'])
+            SEG_PTRS['LABEL_COUNT'] += 1
             return res
-        elif command[0] in FUNC_TABLE:
-            if command[0] == 'function':
-                FUNC_TABLE['caller'] = command[1]
-                res = '//{com}\n'.format(com=command[0]) + FUNC_TABLE[command[0]].format(filename=FILE['name'],
-                                                                                         caller=FUNC_TABLE['caller'],
-                                                                                         nVars=command[2],
-                                                                                         push0n=('@SP\nA=M\nM=0\n@SP\nM=M+1\n'*int(command[2])))
-            elif command[0] == 'call':
-                FUNC_TABLE['calee'] = command[1]
-                FUNC_TABLE['calee_count'] += 1
-                res = '//{com}\n'.format(com=command[0]) + FUNC_TABLE[command[0]].format(filename=FILE['name'],
-                                                                                         caller=FUNC_TABLE['caller'],
-                                                                                         calee=FUNC_TABLE['calee'],
-                                                                                         i = FUNC_TABLE['calee_count'],
-                                                                                         nVars=command[2],
-                                                                                         push0n=('@SP\nA=M\nM=0\n@SP\nM=M+1\n'*int(command[2])))
+        else:
+            return comment(name) + code(TR_TABLE[name])
+    elif name in FLOW_TABLE:
+        res = comment(name) + code(FLOW_TABLE[name], filename=FILE['name'],
+                                   funcName=FUNC_TABLE['caller'],
+                                   label=command.name)
+        return res
+    elif op == FUNCTION:
+        FUNC_TABLE['caller'] = command.name
+        return comment(name) + code(FUNC_TABLE[name], filename=FILE['name'],
+                                    caller=FUNC_TABLE['caller'],
+                                    nVars=command.index) + code(PUSH_0) * command.index
+    elif op == CALL:
+        FUNC_TABLE['calee'] = command.name
+        FUNC_TABLE['calee_count'] += 1
+        return comment(name) + code(FUNC_TABLE[name], filename=FILE['name'],
+                                    caller=FUNC_TABLE['caller'],
+                                    calee=FUNC_TABLE['calee'],
+                                    i = FUNC_TABLE['calee_count'],
+                                    nVars=command.index)
+    elif op == RETURN:
+        res = comment(name) + code(FUNC_TABLE[name], filename=FILE['name'],
+                                   caller=FUNC_TABLE['caller'],
+                                   i = FUNC_TABLE['calee_count'])
+        FUNC_TABLE['calee'] = ''
+        FUNC_TABLE['calee_count'] -= 1
+        return res
+    return pushPop(command)
+
+def segmentAddress(segment, index):
+    # static, temp and pointer addresses need no computation
+    if segment == STATIC:
+        return '{}.{}'.format(FILE['name'], index)
+    elif segment == TEMP:
+        return str(5 + index)
+    elif segment == POINTER:
+        return 'THIS' if index == 0 else 'THAT'
+    return None
+
+def loadSegment(segment, index):
+    # D = segment[index]
+    address = segmentAddress(segment, index)
+    if segment == CONSTANT:
+        return code('@{}\nD=A\n', index)
+    elif address != None:
+        return code('@{}\nD=M\n', address)
+    elif index == 0:
+        return code('@{}\nA=M\nD=M\n', BASE_POINTERS[segment])
+    elif index == 1:
+        return code('@{}\nA=M+1\nD=M\n', BASE_POINTERS[segment])
+    return code('@{}\nD=M\n@{}\nA=D+A\nD=M\n', BASE_POINTERS[segment], index)
+
+def storeSegment(segment, index):
+    # segment[index] = D
+    address = segmentAddress(segment, index)
+    if address != None:
+        return code('@{}\nM=D\n', address)
+    elif index <= MAX_INC_OFFSET:
+        return code('@{}\nA=M\n', BASE_POINTERS[segment]) + code('A=A+1\n') * index + code('M=D\n')
+    return code('@R13\nM=D\n@{}\nD=M\n@{}\nD=D+A\n@R14\nM=D\n@R13\nD=M\n@R14\nA=M\nM=D\n', BASE_POINTERS[segment], index)
+
+def compareResult(jump):
+    # D = -1 if D satisfies jump, else 0
+    num = SEG_PTRS['LABEL_COUNT']
+    SEG_PTRS['LABEL_COUNT'] += 1
+    return code(COMPARE_RESULT, num=num, jump=jump)
+
+def callFunction(name, nArgs):
+    FUNC_TABLE['ret_count'] += 1
+    ret = '{}$ret.{}'.format(FUNC_TABLE['caller'], FUNC_TABLE['ret_count'])
+    return code(CALL_D, ret=ret, name=name, frame=5 + nArgs)
+
+def callShared(name, nArgs):
+    FUNC_TABLE['ret_count'] += 1
+    SHARED_USES['call'] += 1
+    ret = '{}$ret.{}'.format(FUNC_TABLE['caller'], FUNC_TABLE['ret_count'])
+    return code(SHARED_CALL_SITE, ret=ret, name=name, frame=5 + nArgs)
+
+def compareShared(op):
+    FUNC_TABLE['ret_count'] += 1
+    SHARED_USES['compare'] += 1
+    COMPARE_USES[op] += 1
+    ret = '{}$ret.{}'.format(FUNC_TABLE['caller'], FUNC_TABLE['ret_count'])
+    return code(SHARED_COMPARE_SITE, ret=ret, op=OP_NAMES[op].upper())
+
+def sharedRoutines():
+    # the routines used by the translated code, appended after it; every
+    # function ends in a jump, so they are never run into. They count
+    # towards the bootstrap in --stats.
+    FUNC_TABLE['caller'] = 'Bootstrap'
+    if SHARED_USES['call']:
+        yield code(SHARED_CALL)
+    if SHARED_USES['return']:
+        yield code(SHARED_RETURN)
+    for op, jump in CMP_JUMPS.items():
+        if COMPARE_USES[op]:
+            yield code(SHARED_COMPARE, op=OP_NAMES[op].upper(), jump=jump)
+
+def countInstructions(code):
+    # the call and return templates are indented and carry comments
+    return sum(1 for line in map(str.strip, code.split('\n')) if line and line[0] not in '(/')
+
+def countRom(chunks):
+    for chunk in chunks:
+        SHARED_USES['rom'] += countInstructions(chunk)
+        yield chunk
+
+def sizeReport():
+    # ROM saved by each shared routine against the inline -O code and the
+    # cycles it adds to every use
+    # the templates are counted unfilled, their fields do not change the
+    # number of instructions
+    call_inline = countInstructions(CALL_D)
+    call_site = countInstructions(SHARED_CALL_SITE)
+    compare_site = countInstructions(SHARED_COMPARE_SITE)
+    compare_routines = sum(1 for uses in COMPARE_USES.values() if uses)
+    rows = [('call', call_inline, call_site,
+             countInstructions(SHARED_CALL) if SHARED_USES['call'] else 0,
+             call_site + countInstructions(SHARED_CALL) - call_inline),
+            ('return', countInstructions(RETURN_D), 2, countInstructions(SHARED_RETURN) if SHARED_USES['return'] else 0, 2),
+            ('compare', countInstructions(POP_D + '@SP\nAM=M-1\nD=M-D\n' + COMPARE_RESULT), compare_site,
+             compare_routines * countInstructions(SHARED_COMPARE.format(op='EQ', jump='JEQ')),
+             compare_site + COMPARE_CYCLES['shared'] - COMPARE_CYCLES['inline'])]
+    inline_rom = SHARED_USES['rom']
+    lines = ['{:<8} {:>6} {:>7} {:>7} {:>8} {:>10} {:>13}'.format('routine', 'uses', 'inline', 'site', 'routine', 'ROM saved', 'cycles added')]
+    for name, inline, site, routine, cycles in rows:
+        uses = SHARED_USES[name]
+        saved = uses * (inline - site) - routine
+        inline_rom += saved
+        lines.append('{:<8} {:>6} {:>7} {:>7} {:>8} {:>10} {:>13}'.format(name, uses, inline, site, routine, saved, cycles))
+    lines.append('ROM size: {} instructions (about {} with inline call, return and compare), limit 32768'.format(SHARED_USES['rom'], inline_rom))
+    return '\n'.join(lines)
+
+def chunkKind(chunk, optimize=False):
+    # the VM commands a chunk was generated from, as written in its leading
+    # comments; -O chunks may cover several commands, the comments inside
+    # the plain call and return templates are not commands
+    commands = []
+    for line in chunk.split('\n'):
+        if line[:2] != '//' or commands and not optimize:
+            break
+        words = line[2:].split()
+        commands.append(' '.join(words[:2]) if words[0] in ('push', 'pop') else words[0])
+    if commands:
+        return ', '.join(commands)
+    if chunk.startswith('(VM$'):
+        return 'shared routine'
+    return 'bootstrap' if FUNC_TABLE['caller'] == 'Bootstrap' else 'unknown'
+
+def countStats(chunks, optimize=False):
+    commands, functions = STATS['commands'], STATS['functions']
+    for chunk in chunks:
+        if chunk:
+            count = countInstructions(chunk)
+            kind = commands.setdefault(chunkKind(chunk, optimize), [0, 0])
+            kind[0] += 1
+            kind[1] += count
+            functions[FUNC_TABLE['caller']] = functions.get(FUNC_TABLE['caller'], 0) + count
+        yield chunk
+
+def statsReport():
+    # Hack instructions by VM command kind and by function, largest first
+    total = sum(count for uses, count in STATS['commands'].values())
+    share = lambda count: '{:.1f}%'.format(100 * count / total) if total else '-'
+    lines = ['{:<36} {:>7} {:>12} {:>8}'.format('command', 'uses', 'instructions', 'share')]
+    for kind, (uses, count) in sorted(STATS['commands'].items(), key=lambda item: -item[1][1]):
+        lines.append('{:<36} {:>7} {:>12} {:>8}'.format(kind, uses, count, share(count)))
+    functions = sorted(STATS['functions'].items(), key=lambda item: -item[1])
+    lines.append('')
+    lines.append('{:<44} {:>12} {:>8}'.format('function', 'instructions', 'share'))
+    for name, count in functions[:STATS_TOP]:
+        lines.append('{:<44} {:>12} {:>8}'.format(name, count, share(count)))
+    if len(functions) > STATS_TOP:
+        lines.append('... {} more functions'.format(len(functions) - STATS_TOP))
+    lines.append('')
+    lines.append('Total: {} instructions, ROM limit {}'.format(total, ROM_SIZE))
+    if total > ROM_SIZE:
+        lines.append('WARNING: the program is {} instructions over the ROM size'.format(total - ROM_SIZE))
+    return '\n'.join(lines)
 
+def splitCommand(line):
+    return line.split('//', 1)[0].split()
+
+def lowerCommands(commands, size=False):
+    # -O lowering of the commands of one file. While cached is set the top
+    # of the stack is in D and not in RAM; it is written back before labels,
+    # jumps and calls, so every jump target sees the plain stack layout.
+    cached = False
+    i = 0
+    empty, pop_d, push_d = code(''), code(POP_D), code(PUSH_D)
+    while i < len(commands):
+        command = commands[i]
+        op = command.op
+        following = [c.op for c in commands[i + 1:i + 4]] + [None, None, None]
+        load = empty if cached else pop_d
+        flush = push_d if cached else empty
+        used = 1
+        if op in CMP_JUMPS or op == PUSH and command.segment == CONSTANT and following[0] in CMP_JUMPS:
+            # D = x - y, then branch on it directly if an if-goto follows
+            used = 2 if op == PUSH else 1
+            compare = commands[i + used - 1].op
+            jump = CMP_JUMPS[compare]
+            after = following[used - 1:]
+            if op == PUSH:
+                res = load + (code('@{}\nD=D-A\n', command.index) if command.index != 0 else empty)
             else:
-                res = '//{com}\n'.format(com=command[0]) + FUNC_TABLE[command[0]].format(filename=FILE['name'],
-                                                                                         caller=FUNC_TABLE['caller'],
-                                                                                         i = FUNC_TABLE['calee_count'])
-                FUNC_TABLE['calee'] = ''
-                FUNC_TABLE['calee_count'] -= 1
-            return res
-        elif len(command) == 3:
-            return pushPop(command)
+                res = load + code('@SP\nAM=M-1\nD=M-D\n')
+            if size and not cached and op != PUSH and after[0] != IF_GOTO and after[:2] != [NOT, IF_GOTO]:
+                # x and y are popped by the shared routine. With y cached in
+                # D the inline compare is as short as flushing it for a
+                # shared one, so only uncached compares are shared.
+                res = compareShared(compare)
+                cached = True
+            elif after[:2] == [NOT, IF_GOTO]:
+                res += code('@{}${}\nD;{}\n', FUNC_TABLE['caller'], commands[i + used + 1].name, NOT_JUMPS[jump])
+                used += 2
+                cached = False
+            elif after[0] == IF_GOTO:
+                res += code('@{}${}\nD;{}\n', FUNC_TABLE['caller'], commands[i + used].name, jump)
+                used += 1
+                cached = False
+            else:
+                res += compareResult(jump)
+                cached = True
+        elif op == PUSH and command.segment == CONSTANT and following[0] in ALU_A:
+            res = load
+            if following[0] in (ADD, SUB, OR) and command.index == 0:
+                pass
+            elif following[0] in (ADD, SUB) and command.index == 1:
+                res += code('D=D+1\n' if following[0] == ADD else 'D=D-1\n')
+            else:
+                res += code('@{}\n{}\n', command.index, ALU_A[following[0]])
+            used = 2
+            cached = True
+        elif op == PUSH:
+            res = flush + loadSegment(command.segment, command.index)
+            cached = True
+        elif op == POP:
+            if command.segment == CONSTANT:
+                raise ValueError('not a VM command: {}'.format(formatCommand(command)))
+            res = load + storeSegment(command.segment, command.index)
+            cached = False
+        elif op in ALU_M:
+            res = load + code('@SP\nAM=M-1\n{}\n', ALU_M[op])
+            cached = True
+        elif op in (NEG, NOT):
+            if cached:
+                res = code('D=-D\n' if op == NEG else 'D=!D\n')
+            else:
+                res = code('@SP\nA=M-1\nM=-M\n' if op == NEG else '@SP\nA=M-1\nM=!M\n')
+        elif op == LABEL:
+            res = flush + code('({}${})\n', FUNC_TABLE['caller'], command.name)
+            cached = False
+        elif op == GOTO:
+            res = flush + code('@{}${}\n0;JMP\n', FUNC_TABLE['caller'], command.name)
+            cached = False
+        elif op == IF_GOTO:
+            res = load + code('@{}${}\nD;JNE\n', FUNC_TABLE['caller'], command.name)
+            cached = False
+        elif op == FUNCTION:
+            FUNC_TABLE['caller'] = command.name
+            res = code('({})\n', command.name)
+            if command.index != 0:
+                res += code('@SP\nA=M\n') + code('M=0\nA=A+1\n') * command.index + code('D=A\n@SP\nM=D\n')
+            cached = False
+        elif op == CALL:
+            res = flush + (callShared if size else callFunction)(command.name, command.index)
+            cached = False
+        elif op == RETURN:
+            res = code('' if cached else '@SP\nA=M-1\nD=M\n')
+            if size:
+                SHARED_USES['return'] += 1
+                res += code('@VM$RETURN\n0;JMP\n')
+            else:
+                res += code(RETURN_D)
+            cached = False
         else:
-            return 'unknown command\n'
-    
+            res = code('unknown command\n')
+        if OUTPUT['records']:
+            yield res
+        else:
+            yield ''.join(['//{}\n'.format(formatCommand(c)) for c in commands[i:i + used]]) + res
+        i += used
+
+def bootstrap(optimize=False, size=False):
+    FUNC_TABLE['caller'] = 'Bootstrap'
+    yield code(BOOT['code'])
+    if optimize:
+        yield from lowerCommands([VmCommand(CALL, None, 0, 'Sys.init')], size)
+    else:
+        yield emitCommand(VmCommand(CALL, None, 0, 'Sys.init'))
 
+def startTranslation(records=False):
+    # every translation starts from the same state, so that one process can
+    # translate any number of programs with the same results
+    SEG_PTRS['LABEL_COUNT'] = 0
+    FUNC_TABLE['calee_count'] = FUNC_TABLE['ret_count'] = 0
+    SHARED_USES.update(dict.fromkeys(SHARED_USES, 0))
+    COMPARE_USES.update(dict.fromkeys(COMPARE_USES, 0))
+    STATS['commands'].clear()
+    STATS['functions'].clear()
+    OUTPUT['records'] = records
 
-def parseLine(line):
-    #print('parsing line')
-    if line.isspace() or (line[:2] == '//'):
-        #print('not a command')
-        return ''
+def translateCommands(commands, optimize=False, size=False):
+    # translation of a file's VmCommand records
+    if optimize:
+        yield from lowerCommands(list(commands), size)
     else:
-        #print('command found')
-        return parseCommand(line)
+        for command in commands:
+            yield emitCommand(command)
 
-def parse(path):
-    p = Path(path)
+def translateLines(lines, optimize=False, size=False):
+    yield from translateCommands(parseVm(lines), optimize, size)
+
+def translateModules(modules, optimize=False, size=False, records=False):
+    # in-process counterpart of translateDir over (file name, VmCommand
+    # records) pairs, which can be produced while the translation runs. With
+    # records the chunks are tuples of hack_asm instruction records.
+    previous = OUTPUT['records']
+    startTranslation(records)
+    try:
+        FILE['name'] = 'Sys'
+        yield from bootstrap(optimize, size)
+        for name, commands in modules:
+            FILE['name'] = name
+            yield from translateCommands(commands, optimize, size)
+        if size:
+            yield from sharedRoutines()
+    finally:
+        OUTPUT['records'] = previous
+
+def translateFile(p, optimize=False, size=False):
+    startTranslation()
     FILE['name'] = p.stem
     print('Opening single file %s' % FILE['name'])
-    parsed_data = ''
     # Add bootstrap code
-    FUNC_TABLE['caller'] = 'Bootstrap'
-    parsed_data += BOOT['code']
-    parsed_data += parseCommand('call Sys.init 0')
-    for line in p.open():
-        parsed_data += parseLine(line)
-    #print(parsed_data)
-    writeFile(parsed_data, FILE['name'])
-
-def parsedir(path):
-    p = Path(path)
-    FILE['dir'] = p.name
-    parsed_data = ''
+    yield from bootstrap(optimize, size)
+    with p.open() as lines:
+        yield from translateLines(lines, optimize, size)
+    if size:
+        yield from sharedRoutines()
+
+def translateDir(p, optimize=False, size=False):
+    startTranslation()
     # Add bootstrap code
     FILE['name'] = 'Sys'
-    FUNC_TABLE['caller'] = 'Bootstrap'
-    parsed_data += BOOT['code']
-    parsed_data += parseCommand('call Sys.init 0')
+    yield from bootstrap(optimize, size)
     for f in p.glob('*.vm'):
         FILE['name'] = f.stem
         print('Opening dir file %s' % FILE['name'])
-        for line in f.open():
-            parsed_data += parseLine(line)
-    writeFile(parsed_data, FILE['dir'])
+        with f.open() as lines:
+            yield from translateLines(lines, optimize, size)
+    if size:
+        yield from sharedRoutines()
+
+def readFunctions(p):
+    # function name -> (file stem, lines, called functions), in file order
+    functions = {}
+    for f in p.glob('*.vm'):
+        print('Reading dir file %s' % f.stem)
+        name = None
+        with f.open() as lines:
+            for line in lines:
+                command = splitCommand(line)
+                if command and command[0] == 'function':
+                    name = command[1]
+                    functions[name] = (f.stem, [], set())
+                if name != None:
+                    functions[name][1].append(line)
+                    if command and command[0] == 'call':
+                        functions[name][2].add(command[1])
+    return functions
+
+def reachableFunctions(functions, root='Sys.init'):
+    reachable = set()
+    pending = [root]
+    while pending:
+        name = pending.pop()
+        if name not in reachable and name in functions:
+            reachable.add(name)
+            pending.extend(functions[name][2])
+    return reachable
+
+def linkReport(functions, reachable):
+    removed = {}
+    for name, (stem, lines, calls) in functions.items():
+        if name not in reachable:
+            removed.setdefault(stem, []).append(name)
+    kept_lines = sum(len(functions[name][1]) for name in reachable)
+    all_lines = sum(len(lines) for stem, lines, calls in functions.values())
+    lines = ['Linked {} of {} functions, {} of {} VM lines'.format(len(reachable), len(functions), kept_lines, all_lines)]
+    for stem, names in removed.items():
+        lines.append('  {}: removed {}'.format(stem, ', '.join(names)))
+    unresolved = set().union(*[functions[name][2] for name in reachable]) - set(functions)
+    if unresolved:
+        lines.append('Unresolved calls: {}'.format(', '.join(sorted(unresolved))))
+    return '\n'.join(lines)
+
+def translateLinked(p, optimize=False, size=False):
+    # only the functions reachable from Sys.init through call commands are
+    # translated
+    startTranslation()
+    FILE['name'] = 'Sys'
+    yield from bootstrap(optimize, size)
+    functions = readFunctions(p)
+    if 'Sys.init' in functions:
+        reachable = reachableFunctions(functions)
+        print(linkReport(functions, reachable))
+    else:
+        print('Sys.init not found, linking every function')
+        reachable = set(functions)
+    for name, (stem, lines, calls) in functions.items():
+        if name in reachable:
+            FILE['name'] = stem
+            yield from translateLines(lines, optimize, size)
+    if size:
+        yield from sharedRoutines()
+
+def parse(path, optimize=False, size=False, stats=False):
+    p = Path(path)
+    chunks = translateFile(p, optimize or size, size)
+    if stats:
+        chunks = countStats(chunks, optimize or size)
+    writeFile(countRom(chunks) if size else chunks, p.stem)
+    if size:
+        print(sizeReport())
+    if stats:
+        print(statsReport())
+
+def parsedir(path, optimize=False, size=False, link=False, stats=False):
+    p = Path(path)
+    FILE['dir'] = p.name
+    if link:
+        chunks = translateLinked(p, optimize or size, size)
+    else:
+        chunks = translateDir(p, optimize or size, size)
+    if stats:
+        chunks = countStats(chunks, optimize or size)
+    writeFile(countRom(chunks) if size else chunks, FILE['dir'])
+    if size:
+        print(sizeReport())
+    if stats:
+        print(statsReport())
         
 
 def main ():
     argparser = argparse.ArgumentParser(description='Produce HACK assembly program from VM code')
     argparser.add_argument('input')
+    argparser.add_argument('-O', dest='optimize', action='store_true',
+                           help='keep the top of the stack in D and lower common command sequences together')
+    argparser.add_argument('--size', action='store_true',
+                           help='like -O, with call, return and compare as shared routines; prints a ROM size report. '
+                                'Only compares without the stack top cached in D are shared; a shared compare '
+                                'routine saves ROM from the third use of its compare')
+    argparser.add_argument('--link', action='store_true',
+                           help='only translate the functions of a directory reachable from Sys.init')
+    argparser.add_argument('--stats', action='store_true',
+                           help='print the Hack instructions emitted per VM command kind and per function')
     args = argparser.parse_args()
-    if os.path.isfile(args.input):
-        parse(args.input)
+    if os.path.isfile(args.input) and args.link:
+        argparser.error('--link needs a directory')
+    elif os.path.isfile(args.input):
+        parse(args.input, args.optimize, args.size, args.stats)
     elif os.path.isdir(args.input):
-        parsedir(args.input)
+        parsedir(args.input, args.optimize, args.size, args.link, args.stats)
     else:
         print('Path error')
         return None